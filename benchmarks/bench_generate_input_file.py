@@ -0,0 +1,50 @@
+# Usage: python benchmarks/bench_generate_input_file.py [peaks per sample]
+#
+# Purpose: time gcproc.generate_input_file for an increasing number of synthetic samples and show that the time per sample
+# stays flat (linear scaling). Output is written to an in-memory buffer and to a temporary file.
+
+import contextlib
+import tempfile
+import random
+import time
+import sys
+import io
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gcproc
+
+SAMPLE_COUNTS = [250, 500, 1000, 2000, 4000, 8000]
+
+# Build Runs as returned by convert_time, each with between half and all of peak_num peaks
+def make_tables(sample_num, peak_num):
+    tables = []
+    for i in range(0, sample_num):
+        peaks = sorted([[round(random.uniform(0.5, 10.0), 3), round(random.uniform(10, 5000), 5)]
+                        for peak in range(0, random.randint(peak_num // 2, peak_num))])
+        name = "BKC-IV-%03d-1-%.2fh" % (i, (i % 12) / 2)
+        tables.append(gcproc.Run.from_list([name, "Front", peaks]))
+    return tables
+
+def time_call(function):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function()
+    return time.perf_counter() - start
+
+def main():
+    peak_num = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    random.seed(0)
+    reference = gcproc.Run.from_list(["peaks", "Front", [[1.0 + 0.2 * i, 0] for i in range(0, 10)]])
+    
+    print("%8s %12s %12s %16s" % ("samples", "buffer (s)", "file (s)", "file us/sample"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for sample_num in SAMPLE_COUNTS:
+            tables = make_tables(sample_num, peak_num)
+            buffer_time = time_call(lambda: gcproc.generate_input_file(tables, io.StringIO(), reference))
+            file_time = time_call(lambda: gcproc.generate_input_file(tables, tmp + "/input.txt", reference))
+            print("%8d %12.4f %12.4f %16.1f" % (sample_num, buffer_time, file_time, 1e6 * file_time / sample_num))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# Usage: python benchmarks/bench_pipeline.py [--samples 10,100,1000,10000] [--peaks N] [--jitter MINUTES] [--front FRACTION] [--backend native|r|rscript] [--output results.json] [--compare previous.json]
+#
+# Purpose: time every stage of gcproc on synthetic data directories (see synthetic.py) of increasing size: reading the
+# Report.TXT files, generating the GCalignR input files, alignment, fixing the area order and sorting, and writing the
+# workbook. Results are written as JSON (one record per sample count and stage, with the git commit) so that runs on
+# different commits can be compared with --compare.
+# Note: reports are read one by one with extract_report_txt (no process pool, no index) and alignments are not cached, so
+# the timings measure the stages themselves. gcproc's progress output is discarded.
+
+import contextlib
+import subprocess
+import argparse
+import tempfile
+import platform
+import json
+import time
+import sys
+import io
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+import synthetic
+import gcproc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_COUNTS = [10, 100, 1000, 10000]
+STAGES = ["extract_report_txt", "generate_input_file", "alignment", "fix_area_orders/sort_by_time", "write_xl"]
+
+# Run function with gcproc's output discarded and return (result, seconds)
+def time_call(function):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function()
+    return result, time.perf_counter() - start
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd = ROOT, capture_output = True, text = True).stdout.strip()
+    except OSError:
+        return ""
+
+# Time every stage on one synthetic data directory and return {stage: (seconds, items)}
+def bench_pipeline(data_dir, cf_table, backend):
+    timings = {}
+    report_files = sorted([data_dir + "/" + folder + "/Report.TXT" for folder in os.listdir(data_dir) if folder.endswith(".D")])
+
+    runs, seconds = time_call(lambda: [gcproc.extract_report_txt(report_file) for report_file in report_files])
+    timings["extract_report_txt"] = (seconds, len(runs))
+
+    ret_times = gcproc.format_ret(cf_table)
+    input_files = [data_dir + "/input_data_front.txt", data_dir + "/input_data_back.txt"]
+    with contextlib.redirect_stdout(io.StringIO()):
+        detector_runs = [gcproc.convert_time([run for run in runs if run.detector == detector]) for detector in ["Front", "Back"]]
+    references = [gcproc.Run.from_list(["peaks", detector, ret]) for detector, ret in zip(["Front", "Back"], ret_times)]
+
+    def generate():
+        for detector_run, input_file, reference in zip(detector_runs, input_files, references):
+            gcproc.generate_input_file(detector_run, input_file, reference)
+    seconds = time_call(generate)[1]
+    timings["generate_input_file"] = (seconds, len(runs))
+
+    tables, seconds = time_call(lambda: gcproc.get_areas(input_files, ROOT + "/gcproc.R", backend, use_cache = False))
+    timings["alignment"] = (seconds, len(runs))
+
+    def merge():
+        for table, detector in zip(tables, ["Front", "Back"]):
+            table.detectors = [detector] * len(table)
+        fixed = [gcproc.fix_area_orders(table, gcproc.get_is_index(cf_table)) for table in tables]
+        return gcproc.sort_by_time(gcproc.AreaTable.concat(fixed))
+    all_areas, seconds = time_call(merge)
+    timings["fix_area_orders/sort_by_time"] = (seconds, len(all_areas))
+
+    seconds = time_call(lambda: gcproc.write_xl(data_dir, "bench", all_areas, gcproc.get_corr_factors(cf_table),
+                                                gcproc.get_names(cf_table), gcproc.get_is_mw(cf_table)))[1]
+    timings["write_xl"] = (seconds, len(all_areas))
+
+    return timings
+
+# Print the ratio of the new timings to the ones of a previous results file for every sample count and stage in both
+def compare(results, previous_file):
+    with open(previous_file, "r") as f:
+        previous = json.load(f)
+    before = dict([((record["samples"], record["stage"]), record["seconds"]) for record in previous["results"]])
+
+    print("\nCompared to %s (commit %s):" % (previous_file, previous.get("commit", "?")), file = sys.stderr)
+    print("%8s %-30s %10s %10s %8s" % ("samples", "stage", "before (s)", "after (s)", "ratio"), file = sys.stderr)
+    for record in results:
+        key = (record["samples"], record["stage"])
+        if (key in before and before[key] > 0):
+            print("%8d %-30s %10.4f %10.4f %8.2f" % (key[0], key[1], before[key], record["seconds"], record["seconds"] / before[key]), file = sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Time every gcproc stage on synthetic data")
+    parser.add_argument("--samples", default = ",".join([str(count) for count in SAMPLE_COUNTS]), help = "comma separated sample counts (default: %(default)s)")
+    parser.add_argument("--peaks", type = int, default = 20, help = "peaks per run (default: %(default)s)")
+    parser.add_argument("--analytes", type = int, default = 5, help = "analytes in the cf workbook (default: %(default)s)")
+    parser.add_argument("--jitter", type = float, default = 0.02, help = "maximum retention time shift of a run in minutes (default: %(default)s)")
+    parser.add_argument("--front", type = float, default = 0.5, help = "fraction of runs on the Front detector (default: %(default)s)")
+    parser.add_argument("--backend", choices = gcproc.ALIGN_BACKENDS, default = "native")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "write the results to this JSON file instead of stdout")
+    parser.add_argument("--compare", metavar = "FILE", help = "results of a previous run to compare with")
+    args = parser.parse_args()
+
+    results = []
+    print("%8s %-30s %10s %14s" % ("samples", "stage", "time (s)", "us/item"), file = sys.stderr)
+    for sample_num in [int(count) for count in args.samples.split(",")]:
+        with tempfile.TemporaryDirectory() as data_dir:
+            cf_table = synthetic.generate_dataset(data_dir, sample_num, args.peaks, args.analytes, args.jitter, args.front, args.seed)
+            timings = bench_pipeline(data_dir, cf_table, args.backend)
+
+        for stage in STAGES:
+            seconds, items = timings[stage]
+            results.append({'samples': sample_num, 'stage': stage, 'seconds': seconds, 'items': items})
+            print("%8d %-30s %10.4f %14.1f" % (sample_num, stage, seconds, 1e6 * seconds / max(items, 1)), file = sys.stderr)
+
+    report = {'commit': git_commit(),
+              'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'machine': platform.machine(),
+              'parameters': {'peaks': args.peaks, 'analytes': args.analytes, 'jitter': args.jitter, 'front': args.front,
+                             'backend': args.backend, 'seed': args.seed},
+              'results': results}
+
+    if (args.output):
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent = 1)
+    else:
+        json.dump(report, sys.stdout, indent = 1)
+        print()
+
+    if (args.compare):
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# Usage: python benchmarks/synthetic.py [--samples N] [--peaks N] [--analytes N] [--jitter MINUTES] [--front FRACTION] [--seed N] /path/to/output/directory
+#
+# Purpose: generate a synthetic ChemStation data directory for benchmarks: one "*.D" folder per run with a UTF-16
+# Report.TXT peak table, and a matching cf workbook (cf.xlsx) in the output directory.
+# Note: xlrd only reads .xls files, so the cf workbook is written with xlsxwriter and its compiled copy (cf.xlsx.gcproc.npz)
+# is saved next to it. gcproc.read_cf_file loads the compiled copy as long as the workbook is not modified.
+
+import argparse
+import random
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import xlsxwriter
+
+import gcproc
+
+RT_RANGE = (0.5, 10.0) # Minutes
+AREA_RANGE = (100.0, 5000.0) # pA*s
+BACK_OFFSET = 0.25 # Back detector retention times are later than Front ones by about this much
+TIMES = [30, 60, 90, 120, 180, 240, 360, 480, 720, 1440] # Sample times in min, cycled through for the sample names
+
+# Return the analytes of a synthetic cf file as rows [name, front_rt, back_rt, front_cf, back_cf, mw, color]. The
+# internal standard (TMB_IS) sits in the middle of the table, like in cf_example.xls.
+def make_analytes(analyte_num, rng):
+    front_rts = sorted(rng.sample([round(rt / 100, 3) for rt in range(int(RT_RANGE[0] * 100) + 50, int(RT_RANGE[1] * 100) - 50, 15)], analyte_num))
+    is_row = analyte_num // 2
+
+    analytes = []
+    for row in range(0, analyte_num):
+        name = "TMB_IS" if row == is_row else "Analyte-%d" % (row + 1)
+        cf = 1.0 if row == is_row else round(rng.uniform(0.5, 1.5), 4)
+        mw = 168.19 if row == is_row else ""
+        color = "%06X" % rng.randrange(0, 0x1000000)
+        analytes.append([name, front_rts[row], round(front_rts[row] + BACK_OFFSET, 3), cf, round(cf * rng.uniform(0.99, 1.01), 4), mw, color])
+    return analytes
+
+# Write the analytes in the cf workbook layout (two header rows) and save the compiled CalibrationTable next to it.
+# Returns the CalibrationTable.
+def write_cf_workbook(cf_file, analytes):
+    workbook = xlsxwriter.Workbook(cf_file)
+    worksheet = workbook.add_worksheet()
+    worksheet.write_row(0, 0, ["", "Retention Times", "", "Correction Factors", "", "MW", "Colors"])
+    worksheet.write_row(1, 0, ["", "Front", "Back", "Front", "Back", "", ""])
+    for row in range(0, len(analytes)):
+        worksheet.write_row(row + 2, 0, analytes[row])
+    workbook.close()
+
+    columns = [list(column) for column in zip(*analytes)]
+    columns[5] = [mw if mw != "" else float("nan") for mw in columns[5]]
+    cf_table = gcproc.CalibrationTable(*columns)
+    cf_table.save(cf_file + gcproc.CF_CACHE_SUFFIX, os.stat(cf_file), gcproc.hash_file(cf_file))
+    return cf_table
+
+# Write a UTF-16 Report.TXT with the peak table of one run. peaks is a list of (rt, area) pairs.
+def write_report(report_file, sample_name, detector, peaks):
+    lines = ["Data File C:\\Chem32\\1\\DATA\\%s.D" % sample_name,
+             "Sample Name: %s" % sample_name,
+             "",
+             "Signal 1: FID%d %s, %s Signal" % (1 if detector == "Front" else 2, "A" if detector == "Front" else "B", detector),
+             "",
+             "Peak RetTime Sig Type    Area      Area  ",
+             "  #   [min]             [pA*s]      %   ",
+             "----|-------|---|----|----------|--------|"]
+    total = sum([area for rt, area in peaks])
+    for peak in range(0, len(peaks)):
+        rt, area = peaks[peak]
+        lines.append("%4d %7.3f %3d %-4s %10.5f %8.5f" % (peak + 1, rt, 1, "BB" if peak % 3 else "BV S", area, 100 * area / total))
+    lines.append("")
+    lines.append("Totals :                        %10.5f" % total)
+
+    with open(report_file, "w", encoding = "utf-16") as f:
+        f.write("\n".join(lines) + "\n")
+
+# Generate sample_num runs in data_dir. Every run has a peak for most analytes plus impurity peaks up to peak_num peaks,
+# is shifted by up to +/- jitter minutes as a whole and every peak by a tenth of that. front is the fraction of runs on the
+# Front detector. Returns the CalibrationTable of the matching cf workbook (data_dir/cf.xlsx).
+def generate_dataset(data_dir, sample_num, peak_num = 20, analyte_num = 5, jitter = 0.02, front = 0.5, seed = 0):
+    rng = random.Random(seed)
+    os.makedirs(data_dir, exist_ok = True)
+
+    analytes = make_analytes(analyte_num, rng)
+    cf_table = write_cf_workbook(data_dir + "/cf.xlsx", analytes)
+
+    for i in range(0, sample_num):
+        detector = "Front" if rng.random() < front else "Back"
+        sample_name = "SYN-I-%03d-%d-%dmin" % (i // len(TIMES) + 1, 1 if detector == "Front" else 2, TIMES[i % len(TIMES)])
+
+        shift = rng.uniform(-jitter, jitter)
+        ret_times = [row[1] if detector == "Front" else row[2] for row in analytes if rng.random() > 0.1]
+        ret_times += [rng.uniform(*RT_RANGE) for peak in range(len(ret_times), peak_num)]
+        peaks = sorted([(rt + shift + rng.uniform(-jitter, jitter) / 10, rng.uniform(*AREA_RANGE)) for rt in ret_times])
+
+        os.makedirs(data_dir + "/" + sample_name + ".D", exist_ok = True)
+        write_report(data_dir + "/" + sample_name + ".D/Report.TXT", sample_name, detector, peaks)
+
+    return cf_table
+
+def main():
+    parser = argparse.ArgumentParser(description = "Generate a synthetic ChemStation data directory and cf workbook")
+    parser.add_argument("data_dir")
+    parser.add_argument("--samples", type = int, default = 100, help = "number of runs (default: %(default)s)")
+    parser.add_argument("--peaks", type = int, default = 20, help = "peaks per run including the analytes (default: %(default)s)")
+    parser.add_argument("--analytes", type = int, default = 5, help = "analytes in the cf workbook (default: %(default)s)")
+    parser.add_argument("--jitter", type = float, default = 0.02, help = "maximum retention time shift of a run in minutes (default: %(default)s)")
+    parser.add_argument("--front", type = float, default = 0.5, help = "fraction of runs on the Front detector (default: %(default)s)")
+    parser.add_argument("--seed", type = int, default = 0)
+    args = parser.parse_args()
+
+    generate_dataset(args.data_dir, args.samples, args.peaks, args.analytes, args.jitter, args.front, args.seed)
+    print("Generated %d runs and '%s'" % (args.samples, args.data_dir + "/cf.xlsx"))
+
+if __name__ == "__main__":
+    main()
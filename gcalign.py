@@ -0,0 +1,232 @@
+# Purpose: native NumPy peak alignment engine for gcproc. Reproduces what GCalignR's align_chromatograms does with the
+# parameters used in gcproc.R so that alignment can run in-process instead of through an RScript round trip.
+# Note: the algorithm follows the three GCalignR stages - linear shift correction against the reference, partial alignment
+# of peaks to the row mean, and merging of redundant rows. Unlike GCalignR's merge step as far as known, merge_rows only
+# merges rows whose peaks all stay within max_diff_peak2mean of the merged mean. The engine has not been compared against
+# GCalignR output yet (see tests/make_align_fixtures.py), so gcproc uses GCalignR unless --backend native is given.
+
+import heapq
+
+import numpy as np
+
+# Bump whenever a change to this module can change alignment results (invalidates cached alignments in gcproc)
+VERSION = "2"
+
+# Alignment parameters, kept identical to the align_chromatograms call in gcproc.R
+REFERENCE = "peaks"
+MAX_LINEAR_SHIFT = 0.05
+MAX_DIFF_PEAK2MEAN = 0.03
+MIN_DIFF_PEAK2PEAK = 0.03
+STEP_SIZE = 0.01 # GCalignR default step for the linear shift search
+
+ALIGN_PARAMS = {'reference': REFERENCE,
+                'max_linear_shift': MAX_LINEAR_SHIFT,
+                'max_diff_peak2mean': MAX_DIFF_PEAK2MEAN,
+                'min_diff_peak2peak': MIN_DIFF_PEAK2PEAK,
+                'step_size': STEP_SIZE}
+
+# Read a GCalignR tab-delimited input file (as written by gcproc.generate_input_file) and return the sample names and a
+# list of (rt, area) float array pairs, one per sample. Empty cells are skipped. Accepts a path or an open text stream.
+def read_input_file(input_file):
+    if (isinstance(input_file, str)):
+        with open(input_file, "r") as f:
+            lines = f.read().splitlines()
+    else:
+        lines = input_file.read().splitlines()
+
+    names = lines[0].split("\t")
+    rts = [[] for name in names]
+    areas = [[] for name in names]
+
+    for line in lines[2:]: # Skip sample names and "RT Area" header
+        fields = line.split("\t")
+        for j in range(0, min(len(names), len(fields) // 2)):
+            rt = fields[2 * j]
+            if (rt != ""):
+                rts[j].append(float(rt))
+                areas[j].append(float(fields[2 * j + 1]))
+
+    samples = []
+    for j in range(0, len(names)):
+        samples.append((np.asarray(rts[j], dtype=float), np.asarray(areas[j], dtype=float)))
+
+    return names, samples
+
+# Find the linear shift (multiple of step_size within +/- max_linear_shift) that maximises the number of peaks of a sample
+# shared with the reference. Ties are resolved towards the smallest absolute shift. Returns 0 if nothing is shared.
+def linear_shift(rt, reference_rt, max_linear_shift = MAX_LINEAR_SHIFT, step_size = STEP_SIZE):
+    if (len(rt) == 0 or len(reference_rt) == 0):
+        return 0.0
+
+    steps = int(round(max_linear_shift / step_size))
+    shifts = np.arange(-steps, steps + 1) * step_size
+    ref = np.sort(reference_rt)
+
+    # Distance of every shifted peak to its nearest reference peak, for every candidate shift at once
+    shifted = rt[None, :] + shifts[:, None]
+    if (len(ref) == 1):
+        nearest = np.abs(shifted - ref[0])
+    else:
+        pos = np.clip(np.searchsorted(ref, shifted), 1, len(ref) - 1)
+        nearest = np.minimum(np.abs(shifted - ref[pos - 1]), np.abs(shifted - ref[pos]))
+    shared = (nearest <= step_size / 2).sum(axis = 1)
+
+    if (shared.max() == 0):
+        return 0.0
+
+    candidates = np.flatnonzero(shared == shared.max())
+    return float(shifts[candidates[np.argmin(np.abs(shifts[candidates]))]])
+
+# Stack per-sample peak arrays (sorted by RT) into a rows x samples matrix padded with NaN
+def _stack(columns, rows):
+    matrix = np.full((rows, len(columns)), np.nan)
+    for j in range(0, len(columns)):
+        matrix[:len(columns[j]), j] = columns[j]
+    return matrix
+
+# Move the peaks of the given sample columns one row down starting at row i. used is the number of rows in use; the
+# matrices have spare rows and are doubled in size when those run out. Returns (rt, area, used).
+def _shift_down(rt, area, used, i, cols):
+    if (np.any(~np.isnan(rt[used - 1, cols]))):
+        if (used == rt.shape[0]):
+            pad = np.full(rt.shape, np.nan)
+            rt = np.vstack([rt, pad])
+            area = np.vstack([area, pad])
+        used += 1
+    rt[i + 1:used, cols] = rt[i:used - 1, cols]
+    area[i + 1:used, cols] = area[i:used - 1, cols]
+    rt[i, cols] = np.nan
+    area[i, cols] = np.nan
+    return rt, area, used
+
+# Partial alignment: walk the rows and make every peak in a row lie within max_diff_peak2mean of the row mean. Peaks later
+# than the window are moved to the next row; if some peaks are earlier than the window, all other peaks are moved instead.
+def align_rows(rt, area, max_diff_peak2mean = MAX_DIFF_PEAK2MEAN):
+    used = rt.shape[0]
+    i = 0
+    while (i < used):
+        while True:
+            row = rt[i]
+            present = ~np.isnan(row)
+            if (not present.any()):
+                break
+            mean = row[present].mean()
+            early = present & (row < mean - max_diff_peak2mean)
+            late = present & (row > mean + max_diff_peak2mean)
+            if (early.any()):
+                rt, area, used = _shift_down(rt, area, used, i, np.flatnonzero(present & ~early))
+            elif (late.any()):
+                rt, area, used = _shift_down(rt, area, used, i, np.flatnonzero(late))
+            else:
+                break
+        i += 1
+
+    # Drop rows left empty by the shifting
+    rt, area = rt[:used], area[:used]
+    keep = ~np.all(np.isnan(rt), axis = 1)
+    return rt[keep], area[keep]
+
+# Merge adjacent rows whose means are closer than min_diff_peak2peak when no sample has a peak in both rows and every peak
+# of the merged row stays within max_diff_peak2mean of its mean. The closest pair of rows is merged first (the upper one on
+# ties). Candidate pairs are kept in a heap and only the pairs next to a merged row are re-checked, so every merge costs
+# one row instead of the whole matrix.
+def merge_rows(rt, area, min_diff_peak2peak = MIN_DIFF_PEAK2PEAK, max_diff_peak2mean = MAX_DIFF_PEAK2MEAN):
+    rows = rt.shape[0]
+    if (rows < 2):
+        return rt, area
+
+    present = ~np.isnan(rt)
+    means = np.nanmean(rt, axis = 1)
+    following = list(range(1, rows)) + [-1] # Next row that has not been merged away, -1 for none
+    preceding = [-1] + list(range(0, rows - 1))
+    alive = np.ones(rows, dtype = bool)
+    version = [0] * rows # Changes whenever a row takes the peaks of another one
+    candidates = []
+
+    def push(i):
+        j = following[i] if i >= 0 else -1
+        if (j < 0):
+            return
+        diff = abs(means[j] - means[i])
+        if (diff >= min_diff_peak2peak or np.any(present[i] & present[j])):
+            return
+        merged = np.where(present[i], rt[i], rt[j])
+        merged = merged[~np.isnan(merged)]
+        if (np.max(np.abs(merged - merged.mean())) <= max_diff_peak2mean):
+            heapq.heappush(candidates, (diff, i, j, version[i], version[j]))
+
+    for i in range(0, rows - 1):
+        push(i)
+
+    while (len(candidates) > 0):
+        diff, i, j, version_i, version_j = heapq.heappop(candidates)
+        if (not alive[i] or following[i] != j or version[i] != version_i or version[j] != version_j):
+            continue # Stale: one of the rows changed since the pair was checked
+        take = present[j]
+        rt[i, take] = rt[j, take]
+        area[i, take] = area[j, take]
+        present[i] |= take
+        means[i] = rt[i, present[i]].mean()
+        version[i] += 1
+        alive[j] = False
+        following[i] = following[j]
+        if (following[j] >= 0):
+            preceding[following[j]] = i
+        push(preceding[i])
+        push(i)
+
+    return rt[alive], area[alive]
+
+# Align all samples and return (aligned RT matrix, aligned area matrix) as rows x samples arrays with NaN for missing peaks.
+# samples is a list of (rt, area) array pairs and reference_index points at the reference sample ("peaks").
+def align_chromatograms(samples, reference_index = 0, max_linear_shift = MAX_LINEAR_SHIFT,
+                        max_diff_peak2mean = MAX_DIFF_PEAK2MEAN, min_diff_peak2peak = MIN_DIFF_PEAK2PEAK,
+                        step_size = STEP_SIZE):
+    reference_rt = samples[reference_index][0]
+    rt_columns = []
+    area_columns = []
+
+    # Linear shift correction of every sample towards the reference
+    for j in range(0, len(samples)):
+        rt, area = samples[j]
+        order = np.argsort(rt, kind = "stable")
+        rt = rt[order]
+        area = area[order]
+        if (j != reference_index):
+            rt = rt + linear_shift(rt, reference_rt, max_linear_shift, step_size)
+        rt_columns.append(rt)
+        area_columns.append(area)
+
+    rows = max([len(column) for column in rt_columns] + [1])
+    rt = _stack(rt_columns, rows)
+    area = _stack(area_columns, rows)
+
+    rt, area = align_rows(rt, area, max_diff_peak2mean)
+    rt, area = merge_rows(rt, area, min_diff_peak2peak, max_diff_peak2mean)
+
+    return rt, area
+
+# Align the samples of a GCalignR input file and return the analyte area table in the same layout gcproc.R prints:
+# [[sample_name, area1, area2, ...], ...], one column per reference peak in retention time order. Missing peaks are 0.
+def get_analyte_areas(input_file, params = ALIGN_PARAMS):
+    names, samples = read_input_file(input_file)
+    reference_index = names.index(params['reference'])
+
+    rt, area = align_chromatograms(samples, reference_index,
+                                   params['max_linear_shift'],
+                                   params['max_diff_peak2mean'],
+                                   params['min_diff_peak2peak'],
+                                   params['step_size'])
+
+    # Analytes of interest are the rows holding a (non-zero) reference peak
+    reference_rt = rt[:, reference_index]
+    analyte_rows = np.flatnonzero(~np.isnan(reference_rt) & (reference_rt > 0))
+    analyte_areas = np.nan_to_num(area[analyte_rows], nan = 0.0)
+
+    area_table = []
+    for j in range(0, len(names)):
+        if (j == reference_index):
+            continue
+        area_table.append([names[j]] + analyte_areas[:, j].tolist())
+
+    return area_table
@@ -0,0 +1,133 @@
+# Purpose: read raw Agilent GC-FID signal files (*.ch inside each "*.D" folder) and integrate them with NumPy, so that runs
+# can be processed without ChemStation exporting a Report.TXT first.
+# Note: only the version 179 .ch format (OpenLab/ChemStation, 8 byte float samples) is supported. The data block is
+# memory-mapped rather than read into python. RetTime is in minutes and Area in pA*s, as in Report.TXT.
+
+import struct
+import os
+import re
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+DATA_OFFSET = 0x1800 # Samples start after a fixed 6 kB header
+TIME_OFFSET = 0x11A # Big-endian float32 start and end time in ms
+SCALING_OFFSET = 0x127C # Big-endian float64 signal scaling factor
+
+# Signal letter of the detector file, e.g. FID1A.ch is the front detector
+DETECTORS = {'A': 'Front', 'B': 'Back'}
+
+# Integration defaults
+SMOOTH_POINTS = 5
+BASELINE_MINUTES = 0.5
+MIN_SNR = 10.0
+
+# Return the sorted .ch signal files of a data folder (e.g. FID1A.ch and FID2B.ch), an empty list if it has none
+def find_signal_files(data_folder):
+    return [os.path.join(data_folder, name) for name in sorted(os.listdir(data_folder)) if name.lower().endswith(".ch")]
+
+# Read a .ch file and return (times in minutes, samples, scaling). The samples are memory-mapped and not scaled; the
+# signal in pA is samples * scaling.
+def read_ch_file(ch_file):
+    with open(ch_file, "rb") as f:
+        header = f.read(DATA_OFFSET)
+
+    version = header[1:1 + header[0]].decode("ascii", "replace")
+    if (version != "179"):
+        raise ValueError("Unsupported .ch file version '%s' in '%s' (only version 179 is supported)" % (version, ch_file))
+
+    start, end = struct.unpack(">ff", header[TIME_OFFSET:TIME_OFFSET + 8])
+    scaling = struct.unpack(">d", header[SCALING_OFFSET:SCALING_OFFSET + 8])[0]
+
+    samples = np.memmap(ch_file, dtype = "<f8", mode = "r", offset = DATA_OFFSET)
+    times = np.linspace(start / 60000, end / 60000, len(samples))
+
+    return times, samples, scaling
+
+# Pad a window of the given number of points at both ends of a signal by repeating the edge values
+def pad_edges(signal, points):
+    return np.pad(signal, (points // 2, points - points // 2 - 1), mode = "edge")
+
+def moving_average(signal, points):
+    if (points <= 1):
+        return np.asarray(signal, dtype = float)
+    return np.convolve(pad_edges(signal, points), np.ones(points) / points, mode = "valid")
+
+# Estimate the baseline as a smoothed morphological opening (rolling minimum followed by rolling maximum) over a window of
+# the given number of points. Peaks narrower than the window are removed while sloped baselines are followed.
+def estimate_baseline(signal, points):
+    points = max(1, min(points, len(signal)))
+    rolling_min = sliding_window_view(pad_edges(signal, points), points).min(axis = 1)
+    opening = sliding_window_view(pad_edges(rolling_min, points), points).max(axis = 1)
+    return moving_average(opening, points)
+
+# Robust noise level of a signal from the median absolute deviation of its point to point differences
+def estimate_noise(signal):
+    diff = np.diff(signal)
+    if (len(diff) == 0):
+        return 0.0
+    return 1.4826 * np.median(np.abs(diff - np.median(diff))) / np.sqrt(2)
+
+# Find and integrate peaks. Returns (retention times, areas) as float arrays. Peaks are local maxima of the smoothed,
+# baseline corrected signal higher than min_snr times the noise; each is integrated between the nearest valleys (local
+# minima or points within a few noise levels of the baseline) on either side. The noise is measured on the raw signal.
+def integrate_peaks(times, signal, smooth_points = SMOOTH_POINTS, baseline_minutes = BASELINE_MINUTES, min_snr = MIN_SNR):
+    if (len(signal) < 3):
+        return np.zeros(0), np.zeros(0)
+
+    step = (times[-1] - times[0]) / (len(times) - 1)
+    smoothed = moving_average(signal, smooth_points)
+    corrected = smoothed - estimate_baseline(smoothed, int(round(baseline_minutes / step)) if step > 0 else 1)
+    noise = estimate_noise(signal)
+    threshold = min_snr * noise
+
+    inner = corrected[1:-1]
+    apex = np.flatnonzero((inner > corrected[:-2]) & (inner >= corrected[2:]) & (inner > threshold)) + 1
+    valleys = np.flatnonzero(((inner <= corrected[:-2]) & (inner < corrected[2:])) | (inner <= 3 * noise)) + 1
+    valleys = np.concatenate([[0], valleys, [len(corrected) - 1]])
+
+    if (len(apex) == 0):
+        return np.zeros(0), np.zeros(0)
+
+    # Bound every apex by its surrounding valleys and keep the highest apex between each pair of valleys
+    right_pos = np.searchsorted(valleys, apex)
+    left = valleys[right_pos - 1]
+    right = valleys[np.minimum(right_pos, len(valleys) - 1)]
+    order = np.lexsort((-corrected[apex], left))
+    first = np.concatenate([[True], left[order][1:] != left[order][:-1]])
+    keep = np.sort(order[first])
+    apex, left, right = apex[keep], left[keep], right[keep]
+
+    # Sub-sample apex position from a parabola through the apex and its neighbours
+    y0, y1, y2 = corrected[apex - 1], corrected[apex], corrected[apex + 1]
+    curvature = y0 - 2 * y1 + y2
+    offset = np.where(curvature != 0, 0.5 * (y0 - y2) / np.where(curvature != 0, curvature, 1), 0)
+    ret_times = times[apex] + offset * step
+
+    # Trapezoidal areas in pA*s from the cumulative integral of the corrected signal
+    seconds = times * 60
+    cumulative = np.concatenate([[0], np.cumsum((corrected[1:] + corrected[:-1]) / 2 * np.diff(seconds))])
+    areas = cumulative[right] - cumulative[left]
+
+    return ret_times, areas
+
+# Integrate a .ch file of a data folder and return (sample name, detector, retention times, areas). The sample name is
+# the folder name without ".D" and the detector comes from the signal letter of the file name (e.g. FID1A.ch).
+def integrate_signal_file(ch_file):
+    sample_name = re.sub(r"\.D$", "", os.path.basename(os.path.dirname(os.path.abspath(ch_file))))
+
+    match = re.search(r"([A-Z])\.ch$", os.path.basename(ch_file), re.IGNORECASE)
+    if (match is None or match.group(1).upper() not in DETECTORS):
+        raise ValueError("Cannot tell the detector of signal file '%s'" % ch_file)
+    detector = DETECTORS[match.group(1).upper()]
+
+    # Peak detection is unaffected by a positive scale, so the memory-mapped samples are integrated as they are and only
+    # the areas are scaled
+    times, samples, scaling = read_ch_file(ch_file)
+    if (scaling > 0):
+        ret_times, areas = integrate_peaks(times, samples)
+        areas = areas * scaling
+    else:
+        ret_times, areas = integrate_peaks(times, samples * scaling)
+
+    return sample_name, detector, ret_times, areas
@@ -0,0 +1,89 @@
+# Purpose: sample naming conventions for gcproc. A convention is a list of regular expressions with named groups, compiled
+# once; every sample name is parsed once into a SampleKey (initials, notebook, page, entry, time in hours) that is cached
+# and used for renaming, sorting and grouping.
+# Note: the "time" and "unit" (min or h) groups are required, all other groups are optional. Names that match none of the
+# patterns of a convention are rejected by the caller instead of stopping the run.
+
+import re
+
+# Hours per time unit
+UNIT_HOURS = {'min': 1 / 60, 'h': 1.0}
+
+TIME = r"(?P<time>\d+(?:\.\d*)?|\.\d+)(?P<unit>min|h)"
+
+# Built-in conventions, tried pattern by pattern in order
+CONVENTIONS = {
+    # INITIALS-NOTEBOOK-PAGE-ENTRY-TIME(h or min), e.g. BKC-IV-032-1-30min, falling back to anything followed by -TIME
+    'default': [r"(?P<initials>[^-\s]+)-(?P<notebook>[^-\s]+)-(?P<page>[^-\s]+)-(?P<entry>[^-\s]+)-" + TIME + r"(?P<suffix>.*)",
+                r"(?P<notebook>\S+)-" + TIME + r"(?P<suffix>.*)"],
+    # INITIALS-NOTEBOOK-PAGE-ENTRY-TIME(h or min) only
+    'strict': [r"(?P<initials>[^-\s]+)-(?P<notebook>[^-\s]+)-(?P<page>[^-\s]+)-(?P<entry>[^-\s]+)-" + TIME + r"(?P<suffix>.*)"],
+    # NOTEBOOK_ENTRY_TIME with underscores, e.g. IV032_1_30min
+    'underscore': [r"(?P<notebook>[^_\s]+)_(?P<entry>[^_\s]+)_" + TIME + r"(?P<suffix>.*)"],
+}
+
+# Sort value of a name part: numbers sort numerically before text, e.g. page "032" as 32
+def natural(text):
+    try:
+        return (0, float(text), "")
+    except ValueError:
+        return (1, 0.0, text)
+
+# Parsed sample name. hours is the sample time in hours and name the sample name with the time written in hours (e.g.
+# BKC-IV-032-1-0.50h for BKC-IV-032-1-30min).
+class SampleKey:
+    __slots__ = ["initials", "notebook", "page", "entry", "hours", "suffix", "name", "sort_key"]
+
+    def __init__(self, initials, notebook, page, entry, hours, suffix, name):
+        self.initials = initials
+        self.notebook = notebook
+        self.page = page
+        self.entry = entry
+        self.hours = hours
+        self.suffix = suffix
+        self.name = name
+        self.sort_key = (initials, notebook, natural(page), natural(entry), hours, suffix)
+
+    # Runs of the same notebook entry at different times
+    def group(self):
+        return (self.initials, self.notebook, self.page, self.entry)
+
+    def __repr__(self):
+        return "SampleKey(%r, %r, %r, %r, %g h)" % (self.initials, self.notebook, self.page, self.entry, self.hours)
+
+class NamingConvention:
+    def __init__(self, name, patterns):
+        self.name = name
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+        for pattern in self.patterns:
+            if (not set(["time", "unit"]).issubset(pattern.groupindex)):
+                raise ValueError("Naming convention pattern '%s' needs the named groups 'time' and 'unit'" % pattern.pattern)
+        self.keys = {}
+
+    # Return the SampleKey of a sample name, or None if it does not follow the convention. Results are cached per name.
+    def parse(self, name):
+        if (name in self.keys):
+            return self.keys[name]
+
+        key = None
+        for pattern in self.patterns:
+            match = pattern.fullmatch(name)
+            if (match is not None and match.group("unit") in UNIT_HOURS):
+                fields = match.groupdict("")
+                hours = float(fields['time']) * UNIT_HOURS[fields['unit']]
+                hours_name = name[:match.start("time")] + "{:.2f}h".format(hours) + name[match.end("unit"):]
+                key = SampleKey(fields.get('initials', ""), fields.get('notebook', ""), fields.get('page', ""),
+                                fields.get('entry', ""), hours, fields.get('suffix', ""), hours_name)
+                break
+
+        self.keys[name] = key
+        return key
+
+# Return a built-in convention by name, or a custom one if spec is a regular expression with named groups
+def get_convention(spec = "default"):
+    if (spec in CONVENTIONS):
+        return NamingConvention(spec, CONVENTIONS[spec])
+    if ("(?P<" in spec):
+        return NamingConvention("custom", [spec])
+    raise ValueError("Unknown naming convention '%s' (choose from %s or give a regular expression with named groups)" %
+                     (spec, ", ".join(sorted(CONVENTIONS))))
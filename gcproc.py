@@ -7,19 +7,400 @@
 # Note: an excel file named "cf.xls" is used to store retention times, correction factors, and color coding (for output spreadsheet).
 # Front and Back correction factors followed by Front and Back retention times on adjacent columns for a total of 5 columns. Folders "*.D" should be
 # in the same folder as well and contain the "Report.TXT" file.
-# Requirements: You must have R installed with the GCAlignR package also installed. You must have python installed with the xlsxwriter and xlrd packages.
+# Requirements: You must have python installed with the xlsxwriter, xlrd and numpy packages. Alignment runs natively in python
+# by default; to use the GCalignR backend (--backend r) you must have R installed with the GCAlignR package also installed.
 
-import subprocess
-import xlsxwriter
-import xlrd
+import argparse
+import copy
+import time
+import atexit
+import tempfile
+import hashlib
+import zipfile
+import logging
+import heapq
+import csv
 import json
 import sys
 import re
 import os
 
-# Align peaks and return peak area table
-def get_area(input_file, script):
-    output = subprocess.check_output(['RScript', script, input_file], universal_newlines=True)
+import numpy as np
+
+import gcprof
+import gcnames
+
+# xlsxwriter, xlrd, subprocess, sqlite3, concurrent.futures and the gcalign, gcfid and gcwatch modules are imported in the
+# functions that use them, so that importing gcproc (or running a command that does not need them) stays fast.
+
+# Progress and diagnostics go to the "gcproc" logger, which main() sets to warnings only unless -v or -vv is given
+logger = logging.getLogger("gcproc")
+
+# Naming convention used when none is given (INITIALS-NOTEBOOK-PAGE-ENTRY-TIME, see gcnames.py)
+DEFAULT_NAMING = gcnames.get_convention("default")
+
+# Stage profiler for --profile (disabled by default)
+profiler = gcprof.Profiler()
+
+ALIGN_BACKENDS = ["native", "r", "rscript"]
+# GCalignR stays the default until the native engine has been checked against saved GCalignR output (tests/test_gcalign.py)
+DEFAULT_BACKEND = "rscript"
+RSCRIPT_MISSING = "RScript not found; install R and the packages in requirements_R.txt, or use --backend native"
+
+# One chromatogram run. The sample name and detector are stored once and the peak retention times and areas are parsed
+# once into float arrays. name is the name used in the output and key the parsed sample name (gcnames.SampleKey), both set
+# by convert_time; sample_name is the one in the report.
+class Run:
+    __slots__ = ["name", "sample_name", "detector", "rt", "area", "key"]
+
+    def __init__(self, sample_name, detector, rt, area, name = None, key = None):
+        self.sample_name = sample_name
+        self.detector = detector
+        self.rt = np.asarray(rt, dtype = float)
+        self.area = np.asarray(area, dtype = float)
+        self.name = name if name is not None else sample_name
+        self.key = key
+
+    # Build a run from the list form [sample_name, detector, [[rt, area], ...]] (numbers may be strings)
+    @classmethod
+    def from_list(cls, extract):
+        peaks = np.asarray(extract[2], dtype = float).reshape(-1, 2)
+        return cls(extract[0], extract[1], peaks[:, 0], peaks[:, 1])
+
+    def to_list(self):
+        return [self.sample_name, self.detector, np.column_stack([self.rt, self.area]).tolist()]
+
+    # Hash of the peak table, used to tell whether a run changed since it was aligned
+    def fingerprint(self):
+        return hashlib.sha256(self.rt.tobytes() + self.area.tobytes()).hexdigest()
+
+    def __repr__(self):
+        return "Run(%r, %r, %d peaks)" % (self.name, self.detector, len(self.rt))
+
+# Aligned analyte areas: one row per run with its detector, name and SampleKey (None if unknown), and the areas as a
+# runs x analytes float array
+class AreaTable:
+    __slots__ = ["detectors", "names", "areas", "keys"]
+
+    def __init__(self, detectors, names, areas, keys = None):
+        self.detectors = list(detectors)
+        self.names = list(names)
+        self.keys = list(keys) if keys is not None else [None] * len(self.names)
+        self.areas = np.asarray(areas, dtype = float)
+        if (self.areas.ndim != 2):
+            self.areas = self.areas.reshape(len(self.names), -1) if len(self.names) > 0 else np.zeros((0, 0))
+
+    # Build a table from rows of form [sample_name, area1, area2, ...]. Values that are not numbers (e.g. NA) become 0.
+    @classmethod
+    def from_rows(cls, rows, detector = ""):
+        names = [row[0] for row in rows]
+        areas = [[float(value) if isFloat(value) else 0.0 for value in row[1:]] for row in rows]
+        return cls([detector] * len(rows), names, areas)
+
+    def to_rows(self):
+        return [[name] + areas for name, areas in zip(self.names, self.areas.tolist())]
+
+    # Rows of form [detector, sample_name, area1, area2, ...] for the workbook
+    def rows(self):
+        return [[detector, name] + areas for detector, name, areas in zip(self.detectors, self.names, self.areas.tolist())]
+
+    def take(self, order):
+        order = list(order)
+        return AreaTable([self.detectors[i] for i in order], [self.names[i] for i in order], self.areas[order],
+                         [self.keys[i] for i in order])
+
+    @classmethod
+    def concat(cls, tables):
+        tables = [table for table in tables if len(table) > 0]
+        if (len(tables) == 0):
+            return cls([], [], [])
+        return cls(sum([table.detectors for table in tables], []), sum([table.names for table in tables], []),
+                   np.vstack([table.areas for table in tables]), sum([table.keys for table in tables], []))
+
+    def __len__(self):
+        return len(self.names)
+
+# Long-lived GCalignR worker (gcproc_worker.R). Jobs are sent on stdin and the aligned areas and RTs come back as CSV
+# files, so the R startup and library load is paid once per worker instead of once per alignment.
+class RWorker:
+    def __init__(self, script):
+        import subprocess
+        
+        try:
+            self.process = subprocess.Popen(['RScript', script], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            universal_newlines=True, bufsize=1)
+        except FileNotFoundError:
+            raise RuntimeError(RSCRIPT_MISSING)
+        self.prefix = None
+
+    def alive(self):
+        return self.process.poll() is None
+
+    # Send an alignment job without waiting for it, so that several workers can align at the same time
+    def submit(self, input_file):
+        self.prefix = os.path.splitext(input_file)[0] + "_aligned"
+        self.process.stdin.write(input_file + "\t" + self.prefix + "\n")
+        self.process.stdin.flush()
+
+    # Wait for the submitted job and return (area table, RT table), both of form [[sample_name, value1, ...], ...]
+    def result(self):
+        while True:
+            line = self.process.stdout.readline()
+            if (line == ""):
+                raise RuntimeError("alignment worker exited unexpectedly")
+            if (line.startswith("GCPROC_DONE")):
+                break
+            if (line.startswith("GCPROC_ERROR")):
+                raise RuntimeError("alignment failed: %s" % line.split("\t", 1)[1].strip())
+        
+        return read_aligned_csv(self.prefix + "_areas.csv"), read_aligned_csv(self.prefix + "_rt.csv")
+
+    def close(self):
+        if (self.alive()):
+            self.process.stdin.close()
+            self.process.wait()
+
+r_workers = {}
+
+# Return the worker for a slot (e.g. "Front" or "Back"), starting it on first use or if it died
+def get_r_worker(slot, script):
+    if (slot not in r_workers or not r_workers[slot].alive()):
+        r_workers[slot] = RWorker(script)
+    return r_workers[slot]
+
+def close_r_workers():
+    for worker in r_workers.values():
+        worker.close()
+    r_workers.clear()
+
+atexit.register(close_r_workers)
+
+# Read a CSV written by the alignment worker. First column is the sample name, the remaining columns are numeric.
+def read_aligned_csv(csv_file):
+    table = []
+    with open(csv_file, newline='') as f:
+        reader = csv.reader(f)
+        next(reader) # Skip header
+        for line in reader:
+            table.append([line[0]] + [float(value) if value != "NA" else 0.0 for value in line[1:]])
+    return table
+
+# Align several input files and return one peak area table per input file. With the "r" backend every input file is
+# sent to its own persistent worker first so that the alignments run concurrently.
+def align_input_files(input_files, script, backend = DEFAULT_BACKEND):
+    if (backend != "r"):
+        tables = []
+        for input_file in input_files:
+            with profiler.stage("align " + os.path.basename(input_file)) as stage:
+                tables.append(get_area(input_file, script, backend))
+                stage.items = len(tables[-1])
+        return tables
+    
+    worker_script = os.path.join(os.path.dirname(script), "gcproc_worker.R")
+    workers = []
+    for slot in range(0, len(input_files)):
+        worker = get_r_worker(slot, worker_script)
+        worker.submit(input_files[slot])
+        workers.append(worker)
+    
+    # The workers align at the same time, so each stage is the wait for the result of one input file
+    tables = []
+    for input_file, worker in zip(input_files, workers):
+        with profiler.stage("align " + os.path.basename(input_file)) as stage:
+            tables.append(AreaTable.from_rows(worker.result()[0]))
+            stage.items = len(tables[-1])
+    return tables
+
+ALIGN_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gcproc", "alignments")
+ALIGN_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Return a string identifying the alignment code of a backend: the gcalign version or a hash of the R script used
+def backend_version(script, backend):
+    import gcalign
+    
+    if (backend == "native"):
+        return "native-" + gcalign.VERSION
+    if (backend == "r"):
+        script = os.path.join(os.path.dirname(script), "gcproc_worker.R")
+    return backend + "-" + hash_file(script)
+
+# Cache key of an alignment: hash of the input file contents, the alignment parameters and the backend version
+def alignment_key(input_file, version):
+    import gcalign
+    
+    key = hashlib.sha256()
+    with open(input_file, "rb") as f:
+        key.update(f.read())
+    key.update(json.dumps(gcalign.ALIGN_PARAMS, sort_keys = True).encode())
+    key.update(version.encode())
+    return key.hexdigest()
+
+# Return the cached area table for a key or None. A hit refreshes the entry's mtime, which is the LRU order.
+def read_align_cache(key, cache_dir = ALIGN_CACHE_DIR):
+    path = os.path.join(cache_dir, key + ".json")
+    try:
+        with open(path, "r") as f:
+            table = json.load(f)
+    except (OSError, ValueError):
+        return None
+    os.utime(path)
+    return table
+
+def write_align_cache(key, table, cache_dir = ALIGN_CACHE_DIR, max_bytes = ALIGN_CACHE_MAX_BYTES):
+    os.makedirs(cache_dir, exist_ok = True)
+    path = os.path.join(cache_dir, key + ".json")
+    # Write to a private temporary file first so that concurrent runs never see or clobber a partial entry
+    fd, tmp_path = tempfile.mkstemp(dir = cache_dir, suffix = ".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(table, f)
+    os.replace(tmp_path, path)
+    evict_align_cache(cache_dir, max_bytes)
+
+# Delete least recently used entries until the cache holds at most max_bytes
+def evict_align_cache(cache_dir = ALIGN_CACHE_DIR, max_bytes = ALIGN_CACHE_MAX_BYTES):
+    entries = []
+    for name in os.listdir(cache_dir):
+        if (name.endswith(".json")):
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                continue # Evicted by another run
+            entries.append([stat.st_mtime, stat.st_size, name])
+    entries.sort()
+    
+    total = sum([entry[1] for entry in entries])
+    for mtime, size, name in entries:
+        if (total <= max_bytes):
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def clear_align_cache(cache_dir = ALIGN_CACHE_DIR):
+    if (os.path.isdir(cache_dir)):
+        for name in os.listdir(cache_dir):
+            os.remove(os.path.join(cache_dir, name))
+
+# Return one AreaTable per input file, taking alignments of identical input files (with the same parameters and
+# backend version) from the alignment cache and only aligning the rest.
+def get_areas(input_files, script, backend = DEFAULT_BACKEND, use_cache = True):
+    if (not use_cache):
+        return align_input_files(input_files, script, backend)
+    
+    version = backend_version(script, backend)
+    keys = [alignment_key(input_file, version) for input_file in input_files]
+    tables = [read_align_cache(key) for key in keys]
+    
+    missing = [i for i in range(0, len(input_files)) if tables[i] is None]
+    logger.info("Found %d cached alignments, aligning %d input files...", len(input_files) - len(missing), len(missing))
+    aligned = align_input_files([input_files[i] for i in missing], script, backend)
+    for i, table in zip(missing, aligned):
+        write_align_cache(keys[i], table.to_rows())
+        tables[i] = table
+    
+    return [table if isinstance(table, AreaTable) else AreaTable.from_rows(table) for table in tables]
+
+# Fingerprint of the peak reference and everything else that makes previous alignments comparable
+def reference_fingerprint(peak_reference, script, backend):
+    import gcalign
+    
+    key = hashlib.sha256()
+    key.update(json.dumps(peak_reference.rt.tolist()).encode())
+    key.update(json.dumps(gcalign.ALIGN_PARAMS, sort_keys = True).encode())
+    key.update(backend_version(script, backend).encode())
+    return key.hexdigest()
+
+def alignment_state_file(input_file):
+    return os.path.splitext(input_file)[0] + "_state.json"
+
+# Incremental alignment. Each job is [runs, peak_reference, input_file] (runs as returned by convert_time). Samples aligned in a previous run against the same reference, parameters and backend are kept from the
+# state file next to the input file; only new or changed samples are written to "<input file>_new.txt" and aligned against
+# the reference. If the reference, parameters or backend changed, the job falls back to a full alignment of input_file.
+# So does a job in which several runs share a sample name (e.g. a re-injection in another .D folder): the state is keyed
+# by name, so the rows of the full alignment are returned as they are and only the unique names are kept in the state.
+# Note: the aligned rows of a sample depend on the other samples aligned with it, so a sample keeps the areas of the
+# alignment in which it was first aligned and the result can differ from a full alignment of all samples. realign ignores
+# the state, aligns all samples of every job together (as without incremental alignment) and starts a new state.
+# Returns one AreaTable per job with the rows in the order of the runs.
+def get_areas_incremental(jobs, script, backend = DEFAULT_BACKEND, use_cache = True, realign = False):
+    pending = []
+    states = []
+    
+    for analyte_tables, peak_reference, input_file in jobs:
+        reference = reference_fingerprint(peak_reference, script, backend)
+        state = {'reference': reference, 'samples': {}}
+        try:
+            with open(alignment_state_file(input_file), "r") as f:
+                previous = json.load(f)
+            if (previous['reference'] == reference and not realign):
+                state = previous
+        except (OSError, ValueError, KeyError):
+            pass
+        
+        names = [run.name for run in analyte_tables]
+        seen = set()
+        duplicates = set([name for name in names if name in seen or seen.add(name)])
+        new_tables = [run for run in analyte_tables
+                      if (run.name not in state['samples'] or state['samples'][run.name]['fingerprint'] != run.fingerprint())]
+        
+        if (len(state['samples']) == 0 or len(duplicates) > 0):
+            logger.info("Aligning all %d samples of '%s'...", len(analyte_tables), input_file)
+            generate_input_file(analyte_tables, input_file, peak_reference)
+            pending.append(input_file)
+            new_tables = analyte_tables
+        elif (len(new_tables) > 0):
+            logger.info("Aligning %d new samples of '%s'...", len(new_tables), input_file)
+            new_file = os.path.splitext(input_file)[0] + "_new.txt"
+            generate_input_file(new_tables, new_file, peak_reference)
+            pending.append(new_file)
+        else:
+            logger.info("All %d samples of '%s' are already aligned.", len(analyte_tables), input_file)
+            pending.append(None)
+        
+        states.append([state, names, new_tables, duplicates])
+    
+    aligned = get_areas([input_file for input_file in pending if input_file is not None], script, backend, use_cache)
+    
+    area_tables = []
+    for job, (state, names, new_tables, duplicates) in zip(jobs, states):
+        table = None
+        if (pending[len(area_tables)] is not None):
+            table = aligned.pop(0)
+            fingerprints = dict([(run.name, run.fingerprint()) for run in new_tables])
+            for row in table.to_rows():
+                if (row[0] not in duplicates):
+                    state['samples'][row[0]] = {'fingerprint': fingerprints[row[0]], 'areas': row[1:]}
+        
+        # Keep only samples that are still present and save the state for the next run
+        state['samples'] = dict([(name, state['samples'][name]) for name in names if name not in duplicates])
+        with open(alignment_state_file(job[2]), "w") as f:
+            json.dump(state, f)
+        
+        if (len(duplicates) > 0):
+            area_tables.append(table)
+        else:
+            area_tables.append(AreaTable.from_rows([[name] + list(state['samples'][name]['areas']) for name in names]))
+    
+    return area_tables
+
+# Align peaks and return the analyte areas as an AreaTable. The "native" backend aligns in-process with gcalign, the "r"
+# backend uses a persistent GCalignR worker and the "rscript" backend runs the GCalignR script once and reads the printed
+# data frame.
+def get_area(input_file, script, backend = DEFAULT_BACKEND):
+    import subprocess
+    import gcalign
+    
+    if (backend == "native"):
+        return AreaTable.from_rows(gcalign.get_analyte_areas(input_file))
+    if (backend == "r"):
+        return align_input_files([input_file], script, backend)[0]
+    
+    try:
+        output = subprocess.check_output(['RScript', script, input_file], universal_newlines=True)
+    except FileNotFoundError:
+        raise RuntimeError(RSCRIPT_MISSING)
     
     # Locate the start and end of the dataframe with analyte peak areas. If entry names are too long and RScript output cuts each entry into two separate rows, it will error out!
     pattern = 'START(?:\s|.)*END' #?: non capaturing group so that re does not return matched capture group.
@@ -34,36 +415,26 @@ def get_area(input_file, script):
         line = re.split('\s+', data_trim[i])
         area_table.append(line)
     
-    return area_table
+    return AreaTable.from_rows(area_table)
 
+# Move the internal standard column to the end of the area table. is_index counts from 1 (as from get_is_index).
 def fix_area_orders(area_table, is_index):
-    rows = len(area_table)
-    cols = len(area_table[0])
+    cols = area_table.areas.shape[1]
+    is_col = is_index - 1
     
-    print("Fixing area order with IS")
-        
-    fixed_area_table = []
-    
-    for row in range(0, rows):
-        entry = []
-        is_value = 0
-        for col in range(0, cols):
-            if (col == is_index):
-                is_value = area_table[row][col]
-            else:
-                entry.append(area_table[row][col])
-        entry.append(is_value)
-        fixed_area_table.append(entry)
+    logger.debug("Fixing area order with IS")
     
-    return fixed_area_table
+    if (is_col < 0 or is_col >= cols):
+        return area_table
     
-                
+    order = [col for col in range(0, cols) if col != is_col] + [is_col]
+    return AreaTable(area_table.detectors, area_table.names, area_table.areas[:, order], area_table.keys)
 
-# Read in agilent REPORT.txt file and return array with the sample name as the first element,
-# the detector as second element, and an array of format ['peak', 'area'] as the second element. Encoding is utf-16
+# Read in agilent REPORT.txt file and return a Run with the sample name, the detector and the peak retention times and
+# areas. Encoding is utf-16
 def extract_report_txt(report_file):
-    f = open(report_file, "r", encoding='utf-16')
-    content = f.read()
+    with open(report_file, "r", encoding='utf-16') as f:
+        content = f.read()
     
     # Get Front or Back detector
     pattern = "\S+ Signal"
@@ -72,73 +443,178 @@ def extract_report_txt(report_file):
     # Get sample name
     pattern = 'Sample Name: .*'
     sample_name = re.split('\s+', re.findall(pattern, content)[0])[2]
-    print(sample_name)
+    logger.debug("Reading report of %s", sample_name)
 
     # Find the general pattern "Peak RetTime Sig Type Area". Capturing groups 1 and 4 are Peak and Area. Sig is captured for "BB S" case as well.
     pattern = '\s+(\d+)\s+([.\d]+)\s+(\d+)([A-Z\s]+)([.\d]+)'
     result = re.findall(pattern, content)
-    print(result)
     
     # Take only the RetTime and Area
-    analyte_table = []
-    for peak in result:
-        analyte_table.append([peak[1], peak[4]])
-        print("Found Peak: %s, Area: %s" % (peak[1], peak[4]))
+    if (logger.isEnabledFor(logging.DEBUG)):
+        for peak in result:
+            logger.debug("Found Peak: %s, Area: %s", peak[1], peak[4])
     
-    return [sample_name, detector, analyte_table]
+    return Run(sample_name, detector, [peak[1] for peak in result], [peak[4] for peak in result])
 
-# Generate the tab-delimited input txt file for GCalignR using an array of analyte tables of type ['sample name',
-# ['peak', 'area']], and output file path, and peak reference list to align to. The first two lines will be the sample
-# names and column names ('RT', 'Area') respectively. The following lines will contain for each peak the peak-area pair
-# for every sample separated by a tab.
-def generate_input_file(all_analyte_tables, output_file, peak_reference):
-    print("Generating input file for GCalignR at '%s'..." % output_file)
-    
-    # Append peak reference 'sample' to start of analyte tables
-    all_analyte_tables.insert(0, peak_reference)
-
-    # For multiple samples with different number of peaks, find the maximum number of peaks
-    print("\nFinding maximum peak number across samples...")
-    max_peak_num = len(all_analyte_tables[0][2])
-    print("max_peak_num = %d" % max_peak_num)
-    for i in range(1, len(all_analyte_tables)):
-        peak_num = len(all_analyte_tables[i][3])
-        if (max_peak_num < peak_num):
-            max_peak_num = peak_num
-            print("new max_peak_num = %d" % max_peak_num)
-    print("Done.\n")
-    
-    # Initialize the input file information.
-    sample_num = len(all_analyte_tables)
-    sample_name = ""
-    data = ""
-    
-    # For each peak, extract the peak-area pair for that peak in every sample and concat into one line, tab-delim.
-    # Use try, catch block to add in tabs for samples with fewer than the maximum peak number.
-    for i in range(0, max_peak_num):
-        for j in range(0, sample_num):
-            try:
-                data += str(all_analyte_tables[j][3][i][0]) + "\t" + str(all_analyte_tables[j][3][i][1])
-            except:
-                data += "\t"
-            if (j < sample_num - 1):
-                data += "\t"
-            else:
-                data += "\n"
+# Extract a single report and return (report_file, extract, error). Raw signal files (.ch) are integrated with gcfid.
+# Errors are returned as text instead of raised so that one bad file does not abort a whole ingestion run.
+def extract_report_safe(report_file):
+    import gcfid
+    
+    try:
+        if (report_file.lower().endswith(".ch")):
+            return (report_file, Run(*gcfid.integrate_signal_file(report_file)), None)
+        return (report_file, extract_report_txt(report_file), None)
+    except Exception as e:
+        return (report_file, None, "%s: %s" % (type(e).__name__, e))
+
+# Extract a list of reports on a process pool with the given number of workers (1 runs in-process). Returns a list of
+# (report_file, extract, error) in the same order as report_files.
+def extract_reports(report_files, workers = None):
+    import concurrent.futures
+    
+    if (workers is None):
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(report_files)))
+    
+    if (workers == 1):
+        return list(map(extract_report_safe, report_files))
     
-    # Collect sample names and format them as a single string, tab-delim.
-    for i in range(0, sample_num):
-        sample_name += re.sub("[-]", "-", all_analyte_tables[i][0]) # could change - to _ ([-\.])
-        if (i < sample_num - 1):
-            sample_name += "\t"
+    chunksize = max(1, len(report_files) // (workers * 4))
+    with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as executor:
+        return list(executor.map(extract_report_safe, report_files, chunksize = chunksize))
+
+REPORT_INDEX_FILE = ".gcproc_index.sqlite"
+
+# Open (and create if needed) the ingestion index of a data directory. Every parsed report is stored by its path relative
+# to the data directory together with the mtime, size and content hash of the Report.TXT it was parsed from.
+def open_report_index(data_dir):
+    import sqlite3
+    
+    index = sqlite3.connect(os.path.join(data_dir, REPORT_INDEX_FILE))
+    index.execute("CREATE TABLE IF NOT EXISTS reports (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, hash TEXT, extract TEXT)")
+    return index
+
+def hash_file(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+# Split reports into those whose indexed extract is still valid and those that must be parsed. A report is valid if its
+# mtime and size match the index, or failing that if its content hash does. Returns (cached, stale): cached maps the
+# relative path to the extract, stale is a list of [path, mtime, size, hash] (None values if the file cannot be read).
+def lookup_report_index(index, data_dir, paths):
+    indexed = {}
+    for path, mtime, size, digest, extract in index.execute("SELECT path, mtime, size, hash, extract FROM reports"):
+        indexed[path] = (mtime, size, digest, extract)
+    
+    cached = {}
+    stale = []
+    for path in paths:
+        try:
+            stat = os.stat(data_dir + "/" + path)
+        except OSError:
+            stale.append([path, None, None, None])
+            continue
+        
+        entry = indexed.get(path)
+        if (entry is not None and entry[0] == stat.st_mtime and entry[1] == stat.st_size):
+            cached[path] = Run.from_list(json.loads(entry[3]))
+            continue
+        
+        digest = hash_file(data_dir + "/" + path)
+        if (entry is not None and entry[2] == digest):
+            index.execute("UPDATE reports SET mtime = ?, size = ? WHERE path = ?", (stat.st_mtime, stat.st_size, path))
+            cached[path] = Run.from_list(json.loads(entry[3]))
+        else:
+            stale.append([path, stat.st_mtime, stat.st_size, digest])
+    
+    return cached, stale
+
+# Return the paths of the files to ingest for a data folder, relative to the data directory: Report.TXT, or if raw is set
+# every raw FID signal file, each ingested as its own run (FID1A.ch if the folder has none, so that the folder is
+# reported as an error).
+def report_paths(data_dir, folder, raw = False):
+    import gcfid
+    
+    if (raw):
+        signal_files = gcfid.find_signal_files(data_dir + "/" + folder)
+        return [folder + "/" + os.path.basename(signal_file) for signal_file in signal_files] or [folder + "/FID1A.ch"]
+    return [folder + "/Report.TXT"]
+
+# Extract the Report.TXT (or with raw, each integrated .ch signal file) of every data folder. With use_index, reports that
+# are unchanged since the last run are taken from the data directory's index and only new or modified reports are parsed
+# (on a process pool of the given size). Returns (extracts, errors): extracts as Runs in the order of data_folders,
+# errors as a list of [report_file, message].
+def ingest_reports(data_dir, data_folders, workers = None, use_index = True, raw = False):
+    paths = [path for folder in data_folders for path in report_paths(data_dir, folder, raw)]
+    
+    if (use_index):
+        index = open_report_index(data_dir)
+        cached, stale = lookup_report_index(index, data_dir, paths)
+    else:
+        cached = {}
+        stale = [[path, None, None, None] for path in paths]
+    
+    logger.info("Found %d indexed reports, parsing %d new or modified reports...", len(cached), len(stale))
+    results = extract_reports([data_dir + "/" + entry[0] for entry in stale], workers)
+    
+    parsed = {}
+    for entry, (report_file, extract, error) in zip(stale, results):
+        parsed[entry[0]] = (report_file, extract, error)
+        if (use_index and error is None and entry[1] is not None):
+            index.execute("INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?)", (entry[0], entry[1], entry[2], entry[3], json.dumps(extract.to_list())))
+    
+    if (use_index):
+        # Forget reports whose folders are gone
+        index.execute("CREATE TEMP TABLE present (path TEXT PRIMARY KEY)")
+        index.executemany("INSERT INTO present VALUES (?)", [(path,) for path in paths])
+        index.execute("DELETE FROM reports WHERE path NOT IN (SELECT path FROM present)")
+        index.commit()
+        index.close()
+    
+    extracts = []
+    errors = []
+    for path in paths:
+        if (path in cached):
+            extracts.append(cached[path])
+            continue
+        report_file, extract, error = parsed[path]
+        if (error is None):
+            extracts.append(extract)
         else:
-            sample_name += "\n"
+            errors.append([report_file, error])
+    
+    return extracts, errors
 
-    # Open and write the date to file.
-    f = open(output_file, "w")
-    f.write(sample_name)
-    f.write("RT\tArea\n") # "RT" and "Area" are the column headers used in the gcproc.R script
-    f.write(data)
+# Generate the tab-delimited input txt file for GCalignR using a list of Runs (as returned by convert_time), an output file
+# path or open text stream (e.g. io.StringIO for the native aligner), and the peak reference Run to align to. The first two lines will be the
+# sample names and column names ('RT', 'Area') respectively. The following lines will contain for each peak the peak-area
+# pair for every sample separated by a tab. Rows are streamed to the output; the input lists are not modified.
+def generate_input_file(all_analyte_tables, output_file, peak_reference):
+    logger.info("Generating input file for GCalignR at '%s'...", output_file)
+    
+    # Peak reference 'sample' goes first
+    samples = [peak_reference] + list(all_analyte_tables)
+    
+    # Precompute the "peak<TAB>area" cells of every sample and pad samples with fewer peaks than the maximum with empty cells
+    columns = [[str(rt) + "\t" + str(area) for rt, area in zip(sample.rt.tolist(), sample.area.tolist())] for sample in samples]
+    max_peak_num = max([len(column) for column in columns])
+    logger.debug("max_peak_num = %d", max_peak_num)
+    for column in columns:
+        column.extend(["\t"] * (max_peak_num - len(column)))
+    
+    if (isinstance(output_file, str)):
+        f = open(output_file, "w", buffering = 1024 * 1024)
+    else:
+        f = output_file
+    
+    try:
+        f.write("\t".join([sample.name for sample in samples]) + "\n")
+        f.write("RT\tArea\n") # "RT" and "Area" are the column headers used in the gcproc.R script
+        f.writelines("\t".join(row) + "\n" for row in zip(*columns))
+    finally:
+        if (f is not output_file):
+            f.close()
     
 def isFloat(num):
     try:
@@ -147,126 +623,178 @@ def isFloat(num):
     except ValueError:
         return False
 
-# Sort two-dimensional array by index. Returns sorted array
-# Names of experiments are usually as follows: BKC-IV-001-1-1.5h, etc.
-def sort_by_time(report):
-    convert = lambda text : float(text) if isFloat(text) else (float(text.split("h")[0]) if len(re.findall("\d+.?h", text)) == 1 else text)
-    sort_key = lambda key : [convert(c) for c in re.split("[-]+", key[1])]
-    return sorted(report, key = sort_key)
+# Sort an AreaTable by the parsed sample names (notebook, page, entry, then time). Returns sorted table
+# Names of experiments are usually as follows: BKC-IV-001-1-1.5h, etc. Names that do not follow the convention go last.
+def sort_by_time(report, convention = None):
+    keys = table_keys(report, convention)
+    sort_keys = [(0, key.sort_key) if key is not None else (1, name) for key, name in zip(keys, report.names)]
+    return report.take(sorted(range(0, len(report)), key = lambda i : sort_keys[i]))
+    
+# SampleKeys of the rows of an AreaTable: the ones set by convert_time, or for rows without one (e.g. tables built by
+# hand) the name parsed with the convention
+def table_keys(report, convention = None):
+    convention = convention or DEFAULT_NAMING
+    return [key if key is not None else convention.parse(name) for key, name in zip(report.keys, report.names)]
+
+# Set the output name of every Run to its sample name with the time converted to hours, e.g. 30min becomes 0.50h. Returns
+# the Runs that follow the naming convention; the sample names of the others are logged and added to rejects.
+def convert_time(report, convention = None, rejects = None):
+    convention = convention or DEFAULT_NAMING
+    accepted = []
     
-def convert_time(report):
     for entry in report:
-        name = entry[0]
-        print(name)
-        try:
-            pattern = "(\S+-)([\d\.]+)(min|h)(.*)"
-            time = re.findall(pattern, name)[0]
-            
-            num = time[1]
-            unit = time[2]
-            
-            if (str(unit) == "min"):
-                num = int(num) / 60
-                unit = "h"
-            
-            entry.insert(0, time[0] + "{:.2f}".format(float(num)) + unit + time[3])
-        except IndexError:
-            sys.exit("Error: Name of folders must be in the form INITIALS-NOTEBOOK-PAGE-ENTRY-TIME(h or min), e.g. BKC-IV-032-1-30min.D")
+        key = convention.parse(entry.sample_name)
+        if (key is None):
+            logger.warning("Skipping '%s': name does not follow the '%s' naming convention", entry.sample_name, convention.name)
+            if (rejects is not None):
+                rejects.append(entry.sample_name)
+            continue
+        entry.name = key.name
+        entry.key = key
+        accepted.append(entry)
     
-    return report
-
-# Find the index of internal standard in the correction factors file (starts from 1)
-def get_is_index(cf_file):
-    workbook = xlrd.open_workbook(cf_file)
-    worksheet = workbook.sheet_by_index(0)
+    return accepted
 
-    rows = worksheet.nrows
-    index = 0
+CF_CACHE_SUFFIX = ".gcproc.npz"
 
-    for row in range(2, rows): # Account for empty cells and headers before rows begin
-        if (re.match(".*_IS", worksheet.cell_value(row, 0))):
-            index = row - 1
-            
-    return index
+# Correction factors file parsed once into typed arrays, in sheet order: names, front and back retention times, front and
+# back correction factors, MW and colors (hex code), plus the position of the internal standard (-1 if there is none).
+# A compiled copy is kept next to the cf file ("<cf file>.gcproc.npz") so later runs do not need xlrd at all.
+class CalibrationTable:
+    FIELDS = ["names", "front_rt", "back_rt", "front_cf", "back_cf", "mw", "colors"]
 
-# Read the cf file and return table with internal standard row at end
-def read_cf_file(cf_file):
-    workbook = xlrd.open_workbook(cf_file)
-    worksheet = workbook.sheet_by_index(0)
+    def __init__(self, names, front_rt, back_rt, front_cf, back_cf, mw, colors):
+        self.names = np.asarray(names, dtype = str)
+        self.front_rt = np.asarray(front_rt, dtype = float)
+        self.back_rt = np.asarray(back_rt, dtype = float)
+        self.front_cf = np.asarray(front_cf, dtype = float)
+        self.back_cf = np.asarray(back_cf, dtype = float)
+        self.mw = np.asarray(mw, dtype = float)
+        self.colors = np.asarray(colors, dtype = str)
+        
+        # Internal standard is the (last) analyte named "*_IS"
+        self.is_position = -1
+        for row in range(0, len(self.names)):
+            if (re.match(".*_IS", self.names[row])):
+                self.is_position = row
+        
+        # Row order with the internal standard moved to the end, as used for the output tables
+        self.order = np.array([row for row in range(0, len(self.names)) if row != self.is_position] +
+                              ([self.is_position] if self.is_position >= 0 else []), dtype = int)
 
-    rows = worksheet.nrows
-    cols = worksheet.ncols
-    
-    cf_table = []
-    is_line = []
+    # Parse the first sheet of the cf workbook. Rows start after the two header rows.
+    @classmethod
+    def from_workbook(cls, cf_file):
+        import xlrd
+        
+        workbook = xlrd.open_workbook(cf_file)
+        worksheet = workbook.sheet_by_index(0)
+        
+        columns = [[] for field in cls.FIELDS]
+        for row in range(2, worksheet.nrows): # Account for empty cells and headers before rows begin
+            for col in range(0, len(cls.FIELDS)):
+                value = worksheet.cell_value(row, col) if col < worksheet.ncols else ""
+                if (col in (0, 6)):
+                    columns[col].append(str(value))
+                else:
+                    columns[col].append(float(value) if isFloat(value) else float("nan"))
+        
+        return cls(*columns)
 
-    for row in range(2, rows): # Account for empty cells and headers before rows begin
-        line = []
-        for col in range(0, cols):
-            line.append(worksheet.cell_value(row, col))
+    # Load a cf file, using the compiled sidecar if its recorded mtime and size (or failing that, content hash) match. An
+    # unreadable sidecar (e.g. truncated or corrupt) is treated as missing and rebuilt from the workbook.
+    @classmethod
+    def load(cls, cf_file, use_cache = True):
+        cache_file = cf_file + CF_CACHE_SUFFIX
+        stat = os.stat(cf_file)
+        digest = None
         
-        if (re.match(".*_IS", worksheet.cell_value(row, 0))):
-            is_line = line
-            continue # Skip internal standard when building data table
-        cf_table.append(line)
+        cached = cls.read_sidecar(cache_file) if use_cache else None
+        if (cached is not None):
+            table, source_mtime, source_size, source_hash = cached
+            if (source_mtime == stat.st_mtime and source_size == stat.st_size):
+                return table
+            digest = hash_file(cf_file)
+            if (source_hash == digest):
+                table.save(cache_file, stat, digest)
+                return table
         
-    cf_table.append(is_line)
-    
-    return cf_table
-    
-# Returns array of form ['analyte name', 'front_cf', 'back_cf', 'colors']
-def get_corr_factors(cf_table):
-    rows = len(cf_table)
-    
-    correction_factors = []
+        table = cls.from_workbook(cf_file)
+        if (use_cache):
+            table.save(cache_file, stat, digest or hash_file(cf_file))
+        return table
 
-    for row in range(0, rows):
-        correction_factors.append([cf_table[row][0], cf_table[row][3], 
-            cf_table[row][4], cf_table[row][6]])
-    
-    return correction_factors
+    # Return (table, source mtime, source size, source hash) from a compiled sidecar, or None if it is missing or unreadable
+    @classmethod
+    def read_sidecar(cls, cache_file):
+        try:
+            with np.load(cache_file) as cached:
+                return (cls(*[cached[field] for field in cls.FIELDS]), cached["source_mtime"], cached["source_size"],
+                        str(cached["source_hash"]))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+            logger.warning("Ignoring unreadable compiled cf file '%s' (%s)", cache_file, e)
+            return None
 
-# Returns array of form ['analyte name', 'front_ret', 'back_ret']
-def get_ret_times(cf_dir):
-    workbook = xlrd.open_workbook(cf_dir)
-    worksheet = workbook.sheet_by_index(0)
+    # Write the sidecar through a private temporary file so that concurrent runs never see or clobber a partial copy
+    def save(self, cache_file, stat, digest):
+        arrays = dict([(field, getattr(self, field)) for field in self.FIELDS])
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(cache_file)), suffix = ".tmp")
+        except OSError:
+            return # The compiled copy is only an optimisation, e.g. the cf folder may be read-only
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, source_mtime = stat.st_mtime, source_size = stat.st_size, source_hash = digest, **arrays)
+            os.replace(tmp_path, cache_file)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
 
-    rows = worksheet.nrows
-    
-    ret_times = []
+# Return cf as a CalibrationTable, loading it if it is a path
+def load_calibration(cf):
+    if (isinstance(cf, CalibrationTable)):
+        return cf
+    return CalibrationTable.load(cf)
+
+# Find the index of internal standard in the correction factors file (starts from 1)
+def get_is_index(cf_table):
+    return load_calibration(cf_table).is_position + 1
 
-    for row in range(2, rows): # Account for empty cells and headers before rows begin
-        ret_times.append([worksheet.cell_value(row, 0), worksheet.cell_value(row, 1), worksheet.cell_value(row, 2)])
+# Read the cf file and return the calibration table (internal standard row at end of the table views)
+def read_cf_file(cf_file):
+    return load_calibration(cf_file)
     
-    return ret_times
+# Return a list of floats with "" for empty (NaN) cells, as written to the workbook
+def blank_nan(values):
+    return [value if value == value else "" for value in values.tolist()]
+
+# Returns array of form ['analyte name', 'front_cf', 'back_cf', 'colors'] ("" for empty correction factor cells)
+def get_corr_factors(cf_table):
+    order = cf_table.order
+    return [list(row) for row in zip(cf_table.names[order].tolist(), blank_nan(cf_table.front_cf[order]),
+                                     blank_nan(cf_table.back_cf[order]), cf_table.colors[order].tolist())]
+
+# Returns array of form ['analyte name', 'front_ret', 'back_ret'] in sheet order
+def get_ret_times(cf_table):
+    cf_table = load_calibration(cf_table)
+    return [list(row) for row in zip(cf_table.names.tolist(), cf_table.front_rt.tolist(), cf_table.back_rt.tolist())]
 
 # Return name list
 def get_names(cf_table):
-    rows = len(cf_table)
-    
-    names = []
-
-    for row in range(0, rows):
-        names.append(cf_table[row][0])
-    
-    return names
+    return cf_table.names[cf_table.order].tolist()
 
 # Return color list as Hex code
 def get_colors(cf_table):
-    rows = len(cf_table)
-    
-    colors = []
-
-    for row in range(0, rows):
-        colors.append(cf_table[row][6])
+    return cf_table.colors[cf_table.order].tolist()
     
-    return colors
-    
-# Return internal standard MW
+# Return internal standard MW ("" if the cell is empty)
 def get_is_mw(cf_table):
-    rows = len(cf_table)
-    
-    return cf_table[rows - 1][5]
+    mw = float(cf_table.mw[cf_table.order[-1]])
+    return mw if not np.isnan(mw) else ""
 
 # convert coordinate grid e.g. (0,0) to excel cell format e.g. "A1"
 def get_cell(r, c):
@@ -280,47 +808,71 @@ def get_formula(r, c, r_cf, c_cf, r_ratio, c_ratio, c_is, column):
     apply_ratio = '*' + get_cell(r_ratio + 2, c_ratio + 5)
     return if_num + if_det + apply_ratio
 
-def write_block(workbook, worksheet, row, col, title, header_list, data, fmt = None):
-    # Create formats
-    header = workbook.add_format({'font_name': 'Arial', 'bold': True, 'underline': True})
-    bold = workbook.add_format({'font_name': 'Arial', 'bold': True, 'border': 1})
-    normal = workbook.add_format({'font_name': 'Arial', 'border': 1})
-    
-    # Write in title and headers
-    worksheet.write(row, col, title, header)
-    header_col = 0
-    for header in header_list:
-    	worksheet.write(row + 1, col + header_col, header, bold)
-    	header_col += 1
-    
-    # Write in data
-    data_rows = len(data)
-    for entry in range(0, data_rows):
-    	for column in range(0, len(data[0])):
-    	    if (fmt == None):
-    	        fmt = normal
-    	    cell = data[entry][column]
-    	    try:
-    	        cell = float(cell)
-    	    except:
-    	        pass
-    	    worksheet.write(row + entry + 2, col + column, cell, fmt)
-    
-# Write data to excel workbook. Row and columns are defined as the top-left corner of the table including header and title.
-# Data table comes in form [["Detector", "Notebook Code", area1, area2, ...], ...]
-def write_xl(working_dir, experiment_name, data, cf, analytes, is_mw):
-    workbook = xlsxwriter.Workbook(working_dir + "/" + experiment_name + '_yields.xlsx')
-    worksheet = workbook.add_worksheet()
-
-    # Write in correction factor table
+# Create the cell formats of a workbook once, instead of once per block or per column
+def get_formats(workbook):
+    return {'header': workbook.add_format({'font_name': 'Arial', 'bold': True, 'underline': True}),
+            'bold': workbook.add_format({'font_name': 'Arial', 'bold': True, 'border': 1}),
+            'normal': workbook.add_format({'font_name': 'Arial', 'border': 1}),
+            'num': workbook.add_format({'num_format': '0.00'}),
+            'percent': workbook.add_format({'num_format': '0.00%'})}
+
+# Yield the rows of a block as (row, col, values, format): title, headers and then one row per data entry
+def block_rows(row, col, title, header_list, data, formats, fmt = None):
+    if (fmt == None):
+        fmt = formats['normal']
+    
+    yield (row, col, [title], formats['header'])
+    yield (row + 1, col, header_list, formats['bold'])
+    for entry in range(0, len(data)):
+        yield (row + entry + 2, col, data[entry], fmt)
+
+# Write blocks of the form (row, col, title, header_list, data) one whole row at a time and in row order across all blocks,
+# as required by the constant_memory mode of xlsxwriter
+def write_blocks(worksheet, blocks, formats):
+    rows = [block_rows(row, col, title, header_list, data, formats) for row, col, title, header_list, data in blocks]
+    for row, col, values, fmt in heapq.merge(*rows, key = lambda block_row : (block_row[0], block_row[1])):
+        worksheet.write_row(row, col, values, fmt)
+
+ENTRIES_PER_SHEET = 100000 # Larger experiments are split across several worksheets with the same layout
+CONSTANT_MEMORY_ENTRIES = 5000 # Stream rows to disk instead of keeping the sheets in memory above this size
+
+# Write data to excel workbook. Data table is an AreaTable with the detector and notebook code of every row. Experiments
+# with more than entries_per_sheet entries are written to several worksheets, each with the full layout for its entries.
+# constant_memory (default: automatic, for more than CONSTANT_MEMORY_ENTRIES entries) streams rows to disk. A TimeCourse
+# (see aggregate_time_course) is written to an additional "Time course" worksheet.
+def write_xl(working_dir, experiment_name, data, cf, analytes, is_mw, entries_per_sheet = ENTRIES_PER_SHEET, constant_memory = None, time_course = None):
+    import xlsxwriter
+    
+    if (constant_memory is None):
+        constant_memory = len(data) > CONSTANT_MEMORY_ENTRIES
+    
+    workbook = xlsxwriter.Workbook(working_dir + "/" + experiment_name + '_yields.xlsx', {'constant_memory': constant_memory})
+    formats = get_formats(workbook)
+    
+    for start in range(0, max(len(data), 1), entries_per_sheet):
+        worksheet = workbook.add_worksheet()
+        write_sheet(worksheet, data.take(range(start, min(start + entries_per_sheet, len(data)))), cf, analytes, is_mw, formats)
+    
+    if (time_course is not None):
+        write_time_course_sheet(workbook.add_worksheet("Time course"), time_course, formats)
+    
+    workbook.close()
+
+# Write one worksheet. Row and columns are defined as the top-left corner of the table including header and title.
+def write_sheet(worksheet, data, cf, analytes, is_mw, formats):
+    # Set column widths
+    worksheet.set_column(0, 0, 25)
+    worksheet.set_column(1, 5, 12)
+    worksheet.set_column(7, 8, 25)
+    
+    # Correction factor table
     r_cf_start = 0
     c_cf_start = 0
     
     cf_header_list = ["Reagent", "Front", "Back", "Hex Code"]
     cf_title = "Correction Factors"
-    write_block(workbook, worksheet, r_cf_start, c_cf_start, cf_title, cf_header_list, cf)
     
-    # Write in internal standard amounts per entry
+    # Internal standard amounts per entry
     r_mass_start = r_cf_start + len(cf) + 4
     c_mass_start = 0
     
@@ -331,26 +883,12 @@ def write_xl(working_dir, experiment_name, data, cf, analytes, is_mw):
         mw_cell = get_cell(r_mass_start + entry + 2, c_mass_start + 2)
         is_cell = get_cell(r_mass_start + entry + 2, c_mass_start + 3)
         rxn_cell = get_cell(r_mass_start + entry + 2, c_mass_start + 4)
-        is_mass_data.append([data[entry][1], 0, is_mw, "=" + mass_cell + "/" + mw_cell, 0, "=" + is_cell + "/" + rxn_cell])
+        is_mass_data.append([data.names[entry], 0, is_mw, "=" + mass_cell + "/" + mw_cell, 0, "=" + is_cell + "/" + rxn_cell])
         
     mass_header_list = ["Notebook Code", "IS mass (mg)", "IS MW (g/mol)", "IS (mmol)", "Rxn (mmol)", "IS/Rxn"]
     mass_title = "Internal Standard (IS) Added"
-    write_block(workbook, worksheet, r_mass_start, c_mass_start, mass_title, mass_header_list, is_mass_data)
     
-    # Add number formatting to internal standard amounts table
-    columns = len(is_mass_data[0])
-    for col in range(0, columns - 1):
-        start_cell = get_cell(r_mass_start + 2, c_mass_start + 1)
-        end_cell = get_cell(r_mass_start + len(is_mass_data) + 1, c_mass_start + columns)
-        
-        print("Applying conditional formatting for range %s:%s..." % (start_cell, end_cell))
-        
-        num = workbook.add_format({'num_format': '0.00'})
-        
-        worksheet.conditional_format(start_cell + ":" + end_cell, {'type': 'no_errors',
-                                                                   'format': num})
-    
-    # Write in area data and headers
+    # Area data and headers
     r_data_start = 0
     c_data_start = 7
     
@@ -359,7 +897,6 @@ def write_xl(working_dir, experiment_name, data, cf, analytes, is_mw):
     
     data_header_list = ["Detector", "Notebook Code"] + analytes
     data_title = "GC-FID Analyte Areas"
-    write_block(workbook, worksheet, r_data_start, c_data_start, data_title, data_header_list, data)
     
     # Find the internal standard column and top row.
     for analyte_col in range(0, len(analytes)):
@@ -367,9 +904,9 @@ def write_xl(working_dir, experiment_name, data, cf, analytes, is_mw):
     	if (re.match(".*_IS", name)):
     		r_is = r_data_start
     		c_is = c_data_start + analyte_col + 2
-    		print("\nFound internal standard %s at: %s\n" % (name, get_cell(r_is, c_is)))
+    		logger.debug("Found internal standard %s at: %s", name, get_cell(r_is, c_is))
     
-    # Write in formatted data
+    # Formatted data
     r_form_start = r_data_start + len(data) + 4
     c_form_start = c_data_start
     
@@ -378,12 +915,11 @@ def write_xl(working_dir, experiment_name, data, cf, analytes, is_mw):
     form_data = []
     
     # Make formatted data and exclude internal standard column - replace with mass balance.
+    analyte_cols = data.areas.shape[1] - 1 # This excludes the internal standard row - must be last row
     for entry in range(0, len(data)):
         row = ["Enter entry here."] # Initialize and build row array
         row += ['=' + get_cell(r_data_start + 2 + entry, c_data_start + 1)]
         
-        analyte_cols = len(data[0]) - 3 # This excludes the internal standard row - must be last row
-        
         for col in range(0, analyte_cols):
             row += [get_formula(r_data_start + entry + 2, c_data_start, r_cf_start + col + 2, c_cf_start, r_mass_start + entry, c_mass_start, c_is, col)]
         
@@ -391,20 +927,35 @@ def write_xl(working_dir, experiment_name, data, cf, analytes, is_mw):
         
         form_data.append(row)
     
-    write_block(workbook, worksheet, r_form_start, c_form_start, form_title, form_header_list, form_data)
-            
-    # Add conditional formatting to corrected yields
+    write_blocks(worksheet, [(r_cf_start, c_cf_start, cf_title, cf_header_list, cf),
+                             (r_mass_start, c_mass_start, mass_title, mass_header_list, is_mass_data),
+                             (r_data_start, c_data_start, data_title, data_header_list, data.rows()),
+                             (r_form_start, c_form_start, form_title, form_header_list, form_data)], formats)
+    
+    # Add number formatting to internal standard amounts table
+    if (len(is_mass_data) > 0):
+        start_cell = get_cell(r_mass_start + 2, c_mass_start + 1)
+        end_cell = get_cell(r_mass_start + len(is_mass_data) + 1, c_mass_start + len(is_mass_data[0]))
+        
+        logger.debug("Applying conditional formatting for range %s:%s...", start_cell, end_cell)
+        
+        worksheet.conditional_format(start_cell + ":" + end_cell, {'type': 'no_errors',
+                                                                   'format': formats['num']})
+    
+    # Add conditional formatting to corrected yields: one percent format over all columns and a data bar per column
+    start_cell = get_cell(r_form_start + 2, c_form_start + 2)
+    end_cell = get_cell(r_form_start + len(data) + 1, c_form_start + len(analytes) + 1)
+    worksheet.conditional_format(start_cell + ":" + end_cell, {'type': 'no_errors',
+                                                               'format': formats['percent']})
+    
     for analyte_col in range(0, len(analytes)):
         start_cell = get_cell(r_form_start + 2, c_form_start + analyte_col + 2)
         end_cell = get_cell(r_form_start + len(data) + 1, c_form_start + analyte_col + 2)
         
-        print("Applying conditional formatting for range %s:%s..." % (start_cell, end_cell))
+        logger.debug("Applying conditional formatting for range %s:%s...", start_cell, end_cell)
         
-        percent = workbook.add_format({'num_format': '0.00%'})
         color = '#' + cf[analyte_col][3]
         
-        worksheet.conditional_format(start_cell + ":" + end_cell, {'type': 'no_errors',
-                                                                   'format': percent})
         worksheet.conditional_format(start_cell + ":" + end_cell, {'type': 'data_bar', 
                                                                    'bar_solid': True,
                                                                    'min_type': 'num', 
@@ -412,19 +963,260 @@ def write_xl(working_dir, experiment_name, data, cf, analytes, is_mw):
                                                                    'min_value': 0, 
                                                                    'max_value': 1.0,
                                                                    'bar_color': color})
+
+# Read internal standard amounts per entry from a .csv or .xls file with the headers of the workbook's "Internal Standard
+# (IS) Added" table: "Notebook Code", "IS mass (mg)" and "Rxn (mmol)" (other columns are ignored). Returns a dict of
+# notebook code -> (IS mass in mg, reaction amount in mmol).
+def read_is_amounts(is_file):
+    import xlrd
     
-    # Set column widths
-    worksheet.set_column(c_cf_start, c_cf_start, 25)
-    worksheet.set_column(c_cf_start + 1, c_cf_start + 1, 12)
-    worksheet.set_column(c_cf_start + 2, c_cf_start + 2, 12)
-    worksheet.set_column(c_cf_start + 3, c_cf_start + 3, 12)
-    worksheet.set_column(c_cf_start + 4, c_cf_start + 4, 12)
-    worksheet.set_column(c_cf_start + 5, c_cf_start + 5, 12)
-    
-    worksheet.set_column(c_data_start, c_data_start, 25)
-    worksheet.set_column(c_data_start + 1, c_data_start + 1, 25)
-    	
-    workbook.close()
+    if (is_file.lower().endswith(".csv")):
+        with open(is_file, newline = '') as f:
+            rows = list(csv.reader(f))
+    else:
+        worksheet = xlrd.open_workbook(is_file).sheet_by_index(0)
+        rows = [worksheet.row_values(row) for row in range(0, worksheet.nrows)]
+    
+    # Header row is the first row with a "Notebook Code" cell
+    for header_row in range(0, len(rows)):
+        header = [str(cell).strip() for cell in rows[header_row]]
+        if ("Notebook Code" in header):
+            break
+    else:
+        raise ValueError("no 'Notebook Code' header found in '%s'" % is_file)
+    
+    for column in ["IS mass (mg)", "Rxn (mmol)"]:
+        if (column not in header):
+            raise ValueError("no '%s' header found in '%s'" % (column, is_file))
+    name_col = header.index("Notebook Code")
+    mass_col = header.index("IS mass (mg)")
+    rxn_col = header.index("Rxn (mmol)")
+    
+    is_amounts = {}
+    for row in rows[header_row + 1:]:
+        if (len(row) > max(name_col, mass_col, rxn_col) and str(row[name_col]).strip() != ""):
+            mass = float(row[mass_col]) if isFloat(row[mass_col]) else float("nan")
+            rxn = float(row[rxn_col]) if isFloat(row[rxn_col]) else float("nan")
+            is_amounts[str(row[name_col]).strip()] = (mass, rxn)
+    
+    return is_amounts
+
+# Area array of an AreaTable. A table without runs has no columns, so it gets one column per analyte of the cf table.
+def table_areas(data, cf_table):
+    return data.areas if len(data) > 0 else np.zeros((0, len(cf_table.order)))
+
+# Detector corrected response of every analyte for the whole area table at once: (area / IS area) / (front or back
+# correction factor), i.e. the corrected yield without the IS/Rxn factor. The internal standard must be the last area
+# column (see fix_area_orders). Returns a runs x analytes array with NaN for a zero IS area.
+def corrected_ratios(data, cf_table):
+    order = cf_table.order
+    areas = table_areas(data, cf_table)
+    analyte_cols = areas.shape[1] - 1
+    front_cf = cf_table.front_cf[order][:analyte_cols]
+    back_cf = cf_table.back_cf[order][:analyte_cols]
+    front = np.array([detector == "Front" for detector in data.detectors], dtype = bool)
+    
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        cf = np.where(front[:, None], front_cf[None, :], back_cf[None, :])
+        ratios = (areas[:, :analyte_cols] / areas[:, analyte_cols:]) / cf
+    ratios[~np.isfinite(ratios)] = np.nan
+    
+    return ratios
+
+# Compute the corrected yields of the workbook formulas for the whole area table at once:
+# (area / IS area) / (front or back correction factor) * IS/Rxn, with IS/Rxn = (IS mass / IS MW) / Rxn, and the mass
+# balance as the sum over analytes. The internal standard must be the last area column (see fix_area_orders). Entries
+# without IS amounts, or with a zero IS area or amount, get NaN. Returns (yields as runs x analytes, mass balance).
+def compute_yields(data, cf_table, is_amounts):
+    is_mw = cf_table.mw[cf_table.order[-1]]
+    amounts = np.array([is_amounts.get(name, (np.nan, np.nan)) for name in data.names], dtype = float).reshape(len(data), 2)
+    
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        is_ratio = (amounts[:, 0] / is_mw) / amounts[:, 1]
+        yields = corrected_ratios(data, cf_table) * is_ratio[:, None]
+    yields[~np.isfinite(yields)] = np.nan
+    
+    return yields, yields.sum(axis = 1)
+
+YIELD_EXPORT_FORMATS = ["csv", "sqlite", "parquet"]
+SQLITE_TIMEOUT = 60.0 # Seconds to wait for another experiment writing to a shared database
+
+# Long table of corrected yields: one record per run and analyte, plus one "MB" record per run with the mass balance.
+# Returns a dict of column name -> list.
+def yield_records(experiment_name, data, analytes, yields, mass_balance):
+    runs = len(data)
+    analyte_cols = yields.shape[1]
+    areas = data.areas if runs > 0 else np.zeros((0, analyte_cols + 1))
+    names = analytes[:analyte_cols] + ["MB"]
+    
+    return {'experiment': [experiment_name] * (runs * (analyte_cols + 1)),
+            'detector': np.repeat(np.array(data.detectors, dtype = object), analyte_cols + 1).tolist(),
+            'sample': np.repeat(np.array(data.names, dtype = object), analyte_cols + 1).tolist(),
+            'analyte': names * runs,
+            'area': np.column_stack([areas[:, :analyte_cols], np.full(runs, np.nan)]).ravel().tolist(),
+            'is_area': np.repeat(areas[:, analyte_cols], analyte_cols + 1).tolist(),
+            'corrected_yield': np.column_stack([yields, mass_balance]).ravel().tolist()}
+
+# Write yield records next to the workbook as <experiment>_yields.csv, .parquet and/or .sqlite, or with sqlite_db to the
+# table "yields" of that database, which can then be shared between experiments. Rows of the same experiment are replaced.
+def export_yields(working_dir, experiment_name, records, formats, sqlite_db = None):
+    export_records(working_dir + "/" + experiment_name + "_yields", "yields", ["experiment", "sample"], experiment_name, records, formats,
+                   sqlite_db)
+
+# Write records (a dict of column name -> list, with an "experiment" column) as <prefix>.csv, .parquet and/or .sqlite. In
+# SQLite they go to the given table of <prefix>.sqlite or of the sqlite_db database, indexed on index_columns; rows of the
+# same experiment are replaced in one transaction, so experiments can be exported to a shared database concurrently.
+def export_records(prefix, table, index_columns, experiment_name, records, formats, sqlite_db = None):
+    import sqlite3
+    
+    columns = list(records.keys())
+    rows = list(zip(*[records[column] for column in columns]))
+    
+    if ("csv" in formats):
+        with open(prefix + ".csv", "w", newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(rows)
+    
+    if ("sqlite" in formats):
+        types = ["TEXT" if isinstance(value, str) else ("INTEGER" if isinstance(value, int) else "REAL") for value in (rows[0] if len(rows) > 0 else [0.0] * len(columns))]
+        db = sqlite3.connect(sqlite_db or prefix + ".sqlite", timeout = SQLITE_TIMEOUT)
+        db.execute("CREATE TABLE IF NOT EXISTS " + table + " (" + ", ".join([column + " " + sql_type for column, sql_type in zip(columns, types)]) + ")")
+        db.execute("CREATE INDEX IF NOT EXISTS " + table + "_" + index_columns[-1] + " ON " + table + " (" + ", ".join(index_columns) + ")")
+        db.execute("DELETE FROM " + table + " WHERE experiment = ?", (experiment_name,))
+        db.executemany("INSERT INTO " + table + " (" + ", ".join(columns) + ") VALUES (" + ", ".join(["?"] * len(columns)) + ")", rows)
+        db.commit()
+        db.close()
+    
+    if ("parquet" in formats):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet export requires the pyarrow package")
+        pyarrow.parquet.write_table(pyarrow.table(records), prefix + ".parquet")
+
+# Replicate statistics of a kinetics campaign: one row per group (notebook entry and sample time in hours) and one column
+# per analyte. mean and std are over all runs of a group, front_mean and back_mean over the runs of one detector, and
+# agreement is the relative Front-Back difference (front_mean - back_mean) / (mean of both), NaN unless both detectors ran.
+class TimeCourse:
+    __slots__ = ["quantity", "analytes", "groups", "hours", "n_front", "n_back", "mean", "std", "front_mean", "back_mean", "agreement"]
+    
+    def __init__(self, quantity, analytes, groups, hours, n_front, n_back, mean, std, front_mean, back_mean, agreement):
+        self.quantity = quantity
+        self.analytes = list(analytes)
+        self.groups = list(groups)
+        self.hours = hours
+        self.n_front = n_front
+        self.n_back = n_back
+        self.mean = mean
+        self.std = std
+        self.front_mean = front_mean
+        self.back_mean = back_mean
+        self.agreement = agreement
+    
+    # Rows of form [group, hours, Front runs, Back runs, mean, std, F-B of analyte 1, mean, std, F-B of analyte 2, ...] for
+    # the workbook, with empty cells instead of NaN
+    def rows(self):
+        values = np.stack([self.mean, self.std, self.agreement], axis = 2).reshape(len(self), 3 * len(self.analytes)).astype(object)
+        values[np.isnan(values.astype(float))] = ""
+        return [[group, hours, int(n_front), int(n_back)] + row for group, hours, n_front, n_back, row in
+                zip(self.groups, self.hours.tolist(), self.n_front, self.n_back, values.tolist())]
+    
+    # Long table: one record per group and analyte. Returns a dict of column name -> list.
+    def records(self, experiment_name):
+        analyte_num = len(self.analytes)
+        return {'experiment': [experiment_name] * (len(self) * analyte_num),
+                'sample_group': np.repeat(np.array(self.groups, dtype = object), analyte_num).tolist(),
+                'hours': np.repeat(self.hours, analyte_num).tolist(),
+                'analyte': self.analytes * len(self),
+                'quantity': [self.quantity] * (len(self) * analyte_num),
+                'n_front': np.repeat(self.n_front, analyte_num).tolist(),
+                'n_back': np.repeat(self.n_back, analyte_num).tolist(),
+                'mean': self.mean.ravel().tolist(),
+                'std': self.std.ravel().tolist(),
+                'front_mean': self.front_mean.ravel().tolist(),
+                'back_mean': self.back_mean.ravel().tolist(),
+                'front_back_diff': self.agreement.ravel().tolist()}
+    
+    def __len__(self):
+        return len(self.groups)
+
+# Group the runs of an AreaTable by notebook entry (the name parts before the time, see SampleKey.group) and sample time
+# in hours, and compute the statistics of values (runs x analytes, e.g. corrected yields) for all groups and analytes at
+# once with bincount over flattened (group, analyte) indices. NaN values are left out. Runs are grouped by the SampleKeys
+# set by convert_time (see table_keys); runs without one form a group of their own. Returns a TimeCourse sorted by entry and time.
+def aggregate_time_course(data, values, analytes, quantity = "corrected yield", naming = None):
+    analyte_num = values.shape[1] if len(data) > 0 else len(analytes)
+    
+    # Group index of every run, numbered in sort order
+    groups = {}
+    run_groups = []
+    for name, key in zip(data.names, table_keys(data, naming)):
+        if (key is None):
+            group = ((1, name), float("nan"), name)
+        else:
+            group = ((0,) + key.sort_key[:4], key.hours, "-".join([part for part in key.group() if part != ""]))
+        run_groups.append(groups.setdefault(group, len(groups)))
+    ordered = sorted(groups, key = lambda group : (group[0], group[1] if group[1] == group[1] else 0.0))
+    rank = np.empty(len(ordered), dtype = int)
+    rank[[groups[group] for group in ordered]] = np.arange(len(ordered))
+    run_groups = rank[np.array(run_groups, dtype = int)]
+    group_num = len(ordered)
+    
+    front = np.array([detector == "Front" for detector in data.detectors], dtype = bool)
+    values = np.asarray(values, dtype = float).reshape(len(data), analyte_num)
+    valid = ~np.isnan(values)
+    cells = (run_groups[:, None] * analyte_num + np.arange(analyte_num)[None, :]).ravel()
+    
+    # Sum of weights per (group, analyte)
+    def group_sum(weights):
+        return np.bincount(cells, weights = weights.ravel(), minlength = group_num * analyte_num).reshape(group_num, analyte_num)
+    
+    filled = np.where(valid, values, 0.0)
+    front_valid = valid & front[:, None]
+    back_valid = valid & ~front[:, None]
+    count = group_sum(valid.astype(float))
+    front_count = group_sum(front_valid.astype(float))
+    back_count = group_sum(back_valid.astype(float))
+    
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        mean = group_sum(filled) / count
+        deviation = np.where(valid, values - mean[run_groups], 0.0) # Two-pass variance, stable for large values
+        std = np.sqrt(group_sum(deviation ** 2) / (count - 1))
+        front_mean = group_sum(np.where(front_valid, values, 0.0)) / front_count
+        back_mean = group_sum(np.where(back_valid, values, 0.0)) / back_count
+        agreement = (front_mean - back_mean) / ((front_mean + back_mean) / 2)
+    std[count < 2] = np.nan
+    agreement[~np.isfinite(agreement)] = np.nan
+    
+    n_front = np.bincount(run_groups, weights = front, minlength = group_num).astype(int)
+    n_back = np.bincount(run_groups, minlength = group_num) - n_front
+    
+    return TimeCourse(quantity, analytes[:analyte_num], [group[2] for group in ordered], np.array([group[1] for group in ordered], dtype = float),
+                      n_front, n_back, mean, std, front_mean, back_mean, agreement)
+
+# Time course of an AreaTable: corrected yields if IS amounts are given, otherwise the IS normalized and correction factor
+# corrected response ratios (see corrected_ratios), which are proportional to the yields of runs with the same IS/Rxn.
+def time_course(data, cf_table, is_amounts = None, naming = None):
+    analytes = get_names(cf_table)
+    if (len(data) == 0):
+        return aggregate_time_course(data, np.zeros((0, len(analytes) - 1)), analytes[:-1], naming = naming)
+    if (is_amounts):
+        return aggregate_time_course(data, compute_yields(data, cf_table, is_amounts)[0], analytes, "corrected yield", naming)
+    return aggregate_time_course(data, corrected_ratios(data, cf_table), analytes, "corrected ratio", naming)
+
+# Write a TimeCourse to a worksheet: one row per group with the mean, standard deviation and Front-Back difference of every
+# analyte
+def write_time_course_sheet(worksheet, time_course, formats):
+    worksheet.set_column(0, 0, 25)
+    worksheet.set_column(1, 3 + 3 * len(time_course.analytes), 12)
+    
+    header_list = ["Group", "Time (h)", "Front runs", "Back runs"]
+    for analyte in time_course.analytes:
+        header_list += [analyte + " mean", analyte + " std", analyte + " F-B"]
+    title = "Time Course (" + time_course.quantity + ")"
+    write_blocks(worksheet, [[0, 0, title, header_list, time_course.rows()]], formats)
 
 # format retention time array for GCalignR    
 def format_ret(cf_table):
@@ -439,75 +1231,523 @@ def format_ret(cf_table):
     
     return [front_ret, back_ret]
 
-def main():
+# Sorted index of the reference retention times of one detector (as returned by format_ret). Peaks further than the window
+# (in minutes) from every reference retention time cannot become analytes and are dropped before alignment.
+class RetentionIndex:
+    __slots__ = ["ret_times", "window"]
+
+    def __init__(self, reference, window):
+        ret_times = np.asarray([entry[0] for entry in reference], dtype = float)
+        self.ret_times = np.sort(ret_times[ret_times > 0]) # Analytes without a retention time on this detector are empty or 0
+        self.window = float(window)
+
+    # Boolean mask of the retention times within the window of their nearest reference retention time
+    def contains(self, rt):
+        if (len(self.ret_times) == 0):
+            return np.zeros(len(rt), dtype = bool)
+        pos = np.searchsorted(self.ret_times, rt)
+        before = self.ret_times[np.maximum(pos - 1, 0)]
+        after = self.ret_times[np.minimum(pos, len(self.ret_times) - 1)]
+        return np.minimum(np.abs(rt - before), np.abs(rt - after)) <= self.window
+
+    # Return a copy of the run with only the peaks inside the index and the number of peaks discarded
+    def filter_run(self, run):
+        keep = self.contains(run.rt)
+        return Run(run.sample_name, run.detector, run.rt[keep], run.area[keep], run.name, run.key), int(len(keep) - keep.sum())
+
+# Drop the peaks of every run outside the retention time index. The number of kept and discarded peaks of every sample
+# is added to report (a list) if given. Returns the filtered runs.
+def filter_peaks(runs, index, report = None):
+    filtered = []
+    discarded = 0
+    
+    logger.info("Discarding peaks further than %g min from a reference retention time:", index.window)
+    for run in runs:
+        kept, count = index.filter_run(run)
+        logger.debug("  %s (%s): kept %d, discarded %d", run.sample_name, run.detector, len(kept.rt), count)
+        if (report is not None):
+            report.append({'sample': run.sample_name, 'detector': run.detector, 'kept': len(kept.rt), 'discarded': count})
+        filtered.append(kept)
+        discarded += count
+    logger.info("Discarded %d peaks from %d samples", discarded, len(runs))
+    
+    return filtered
+
+# Print the kept and discarded peak counts of every sample (as collected by filter_peaks)
+def print_peak_report(report, window):
+    print("Peaks further than %g min from a reference retention time:" % window)
+    for entry in report:
+        print("  %-40s %-5s kept %4d, discarded %4d" % (entry['sample'], entry['detector'], entry['kept'], entry['discarded']))
+    print("Discarded %d peaks from %d samples" % (sum([entry['discarded'] for entry in report]), len(report)))
+
+# Library API: the stages of process_experiment for use from python, e.g.
+#   cf_table = gcproc.get_calibration("cf.xls")
+#   runs, errors = gcproc.ingest(data_dir)
+#   areas, rejects = gcproc.align(runs, cf_table, data_dir)
+#   yields, mass_balance = gcproc.compute(areas, cf_table, "is_amounts.csv")
+#   gcproc.write(data_dir, "experiment name", areas, cf_table, export_formats = ["csv"])
+
+R_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gcproc.R")
+
+calibration_tables = {}
+
+# Return the CalibrationTable of a cf file. Tables are kept in memory while the file's mtime and size are unchanged.
+def get_calibration(cf_file):
+    stat = os.stat(cf_file)
+    key = os.path.abspath(cf_file)
+    
+    if (key in calibration_tables and calibration_tables[key][0] == (stat.st_mtime, stat.st_size)):
+        return calibration_tables[key][1]
+    
+    cf_table = load_calibration(cf_file)
+    calibration_tables[key] = ((stat.st_mtime, stat.st_size), cf_table)
+    return cf_table
+
+# Read the reports of the "*.D" folders of a data directory (or only the given folders). Returns (runs, errors) as
+# ingest_reports; reports that cannot be read are logged and returned in errors.
+def ingest(data_dir, data_folders = None, workers = None, use_index = True, raw = False):
+    if (data_folders is None):
+        data_list = os.listdir(data_dir)
+        data_folders = sorted(filter(re.compile(".*\.D").match, data_list))
+    
+    with profiler.stage("ingestion", len(data_folders)):
+        runs, errors = ingest_reports(data_dir, data_folders, workers, use_index, raw)
+    for report_file, error in errors:
+        logger.warning("Skipping '%s': %s", report_file, error)
+    
+    return runs, errors
+
+# Align the Front and Back runs against the retention times of the cf table, writing the GCalignR input files (and the
+# incremental alignment state) to work_dir. Returns (areas, rejects): the AreaTable of all runs with the internal
+# standard as last column, sorted by name, and the sample names rejected by the naming convention. With peak_window, the
+# kept and discarded peak counts of every run are added to peak_report (a list, see filter_peaks) if given. realign
+# re-aligns all runs in incremental mode (see get_areas_incremental).
+def align(runs, cf_table, work_dir, backend = DEFAULT_BACKEND, use_cache = True, incremental = False, peak_window = None, naming = None,
+          peak_report = None, realign = False):
+    # Get Front and Back retention times
+    ret_times = format_ret(cf_table)
+    logger.info("Found %s front retention times, %s back retention times.", len(ret_times[0]), len(ret_times[1]))
+    peak_reference_front = Run.from_list(["peaks", "Front", ret_times[0]])
+    peak_reference_back = Run.from_list(["peaks", "Back", ret_times[1]])
+    
+    # organize as back or front detector
+    report_extracted_front = [run for run in runs if run.detector == "Front"]
+    report_extracted_back = [run for run in runs if run.detector != "Front"]
+    logger.debug("Extracted Report: %s %s", report_extracted_front, report_extracted_back)
+    
+    # Drop peaks that cannot be analytes so that they are not aligned
+    if (peak_window is not None):
+        with profiler.stage("peak filter", len(runs)):
+            report_extracted_front = filter_peaks(report_extracted_front, RetentionIndex(ret_times[0], peak_window), peak_report)
+            report_extracted_back = filter_peaks(report_extracted_back, RetentionIndex(ret_times[1], peak_window), peak_report)
+    
+    # Generate input files for GCalignR and process data. Runs whose names do not follow the naming convention are rejected.
+    rejects = []
+    front_runs = convert_time(report_extracted_front, naming, rejects)
+    back_runs = convert_time(report_extracted_back, naming, rejects)
+    if (incremental):
+        with profiler.stage("incremental alignment", len(runs)):
+            jobs = [[front_runs, peak_reference_front, work_dir + '/input_data_front.txt'],
+                    [back_runs, peak_reference_back, work_dir + '/input_data_back.txt']]
+            front_areas, back_areas = get_areas_incremental(jobs, R_SCRIPT, backend, use_cache, realign)
+    else:
+        with profiler.stage("input generation", len(runs)):
+            generate_input_file(front_runs, work_dir + '/input_data_front.txt', peak_reference_front) 
+            generate_input_file(back_runs, work_dir + '/input_data_back.txt', peak_reference_back)
+        
+        with profiler.stage("alignment", len(runs)):
+            front_areas, back_areas = get_areas([work_dir + '/input_data_front.txt', work_dir + '/input_data_back.txt'],
+                                                R_SCRIPT, backend, use_cache)
+    
+    with profiler.stage("merge/sort", len(front_areas) + len(back_areas)):
+        front_areas = fix_area_orders(front_areas, get_is_index(cf_table))
+        back_areas = fix_area_orders(back_areas, get_is_index(cf_table))
+        
+        # Add detectors and the SampleKeys parsed by convert_time, and sort
+        front_areas.detectors = ["Front"] * len(front_areas)
+        back_areas.detectors = ["Back"] * len(back_areas)
+        keys = dict([(run.name, run.key) for run in front_runs + back_runs])
+        front_areas.keys = [keys.get(name) for name in front_areas.names]
+        back_areas.keys = [keys.get(name) for name in back_areas.names]
+        
+        all_areas = sort_by_time(AreaTable.concat([front_areas, back_areas]), naming)
+    
+    return all_areas, rejects
+
+# Corrected yields and mass balance of an AreaTable (see compute_yields). is_amounts is a dict of notebook code ->
+# (IS mass, Rxn) or the path of a file as read by read_is_amounts.
+def compute(areas, cf_table, is_amounts = None):
+    if (isinstance(is_amounts, str)):
+        is_amounts = read_is_amounts(is_amounts)
+    return compute_yields(areas, cf_table, is_amounts or {})
+
+# Write the workbook <experiment_name>_yields.xlsx to work_dir and export the corrected yields in the given formats. With
+# with_time_course, the replicate statistics per entry and time are added to the workbook as a "Time course" sheet and
+# exported as <experiment_name>_timecourse in the same formats. sqlite_db is a database shared by the SQLite exports of
+# every experiment, instead of one per experiment (see export_records).
+def write(work_dir, experiment_name, areas, cf_table, export_formats = (), is_amounts = None, with_time_course = False, naming = None,
+          sqlite_db = None):
+    analytes = get_names(cf_table)
+    if (isinstance(is_amounts, str)):
+        is_amounts = read_is_amounts(is_amounts)
+    
+    course = None
+    if (with_time_course):
+        with profiler.stage("time course", len(areas)):
+            course = time_course(areas, cf_table, is_amounts, naming)
+            if (len(export_formats) > 0):
+                export_records(work_dir + "/" + experiment_name + "_timecourse", "timecourse", ["experiment", "sample_group"],
+                               experiment_name, course.records(experiment_name), export_formats, sqlite_db)
+    
+    with profiler.stage("workbook write", len(areas)):
+        write_xl(work_dir, experiment_name, areas, get_corr_factors(cf_table), analytes, get_is_mw(cf_table), time_course = course)
+    
+    # Compute corrected yields in python and export them next to the workbook
+    if (len(export_formats) > 0):
+        with profiler.stage("yield export", len(areas)):
+            yields, mass_balance = compute(areas, cf_table, is_amounts)
+            export_yields(work_dir, experiment_name, yield_records(experiment_name, areas, analytes, yields, mass_balance), export_formats,
+                          sqlite_db)
+
+# Process one experiment: ingest the data directory (or only the given data folders), align, write the workbook and export
+# yields. options holds the parsed command line options (see get_options). Returns counts of the runs written, the
+# reports skipped and the runs rejected by the naming convention, and with a peak window the kept and discarded peaks of
+# every run ('peak_report', see filter_peaks).
+def process_experiment(data_dir, cf_table, experiment_name, options, data_folders = None):
+    runs, errors = ingest(data_dir, data_folders, options.workers, not options.no_index, options.raw)
+    peak_report = []
+    all_areas, rejects = align(runs, cf_table, data_dir, options.backend, not options.no_cache, options.incremental,
+                               options.peak_window, options.naming_convention, peak_report, options.realign)
+    write(data_dir, experiment_name, all_areas, cf_table, options.export_formats, options.is_amounts, options.time_course,
+          options.naming_convention, options.sqlite_db)
+    
+    logger.info("Wrote %d runs of '%s' to '%s'", len(all_areas), experiment_name, data_dir)
+    return {'runs': len(all_areas), 'skipped': len(errors), 'rejected': len(rejects), 'peak_report': peak_report}
+
+WATCH_DEBOUNCE = 10.0 # Seconds without changes before an update is processed
+WATCH_SETTLE = 5.0 # Seconds a report must be unmodified before it is considered complete
+WATCH_POLL = 2.0 # Seconds between checks
+WATCH_REALIGN = 300.0 # Seconds without changes or pending reports before all samples are aligned again
+
+# Return the data folders whose report (Report.TXT, or the .ch file with raw) exists and has not been modified for settle
+# seconds, and whether some folders are still being written. A signature of the ready reports is returned as well.
+def ready_data_folders(data_dir, raw = False, settle = WATCH_SETTLE):
+    import gcwatch
+    
+    ready = []
+    signature = []
+    pending = False
+    now = time.time()
+    
+    for folder in gcwatch.list_data_folders(data_dir):
+        try:
+            stats = [os.stat(data_dir + "/" + path) for path in report_paths(data_dir, folder, raw)]
+        except OSError:
+            pending = True # Acquisition still running, no report yet
+            continue
+        if (any([now - stat.st_mtime < settle for stat in stats])):
+            pending = True
+            continue
+        ready.append(folder)
+        signature.append((folder, [(stat.st_mtime, stat.st_size) for stat in stats]))
+    
+    return ready, signature, pending
+
+# Watch a data directory while a sequence is acquiring. Whenever new or changed reports have been quiet for debounce
+# seconds, the complete ones are ingested and the alignment and workbook are updated incrementally. Once nothing has
+# changed for realign seconds and no report is pending, all samples are aligned again as in a full run (see --realign),
+# so that the final workbook does not depend on the order in which the runs arrived. Runs until interrupted.
+def watch_experiment(data_dir, cf_table, experiment_name, options, debounce = WATCH_DEBOUNCE, poll = False, realign = WATCH_REALIGN):
+    import gcwatch
+    
+    options = copy.copy(options)
+    options.incremental = True
+    full_options = copy.copy(options)
+    full_options.realign = True
+    
+    watcher = gcwatch.get_watcher(data_dir, poll)
+    print("Watching '%s' (%s), press Ctrl+C to stop..." % (data_dir, type(watcher).__name__))
+    
+    processed = None
+    processed_folders = None
+    realigned = None
+    dirty = True
+    last_change = 0.0
+    last_update = 0.0
+    try:
+        while True:
+            if (watcher.wait(WATCH_POLL)):
+                dirty = True
+                last_change = time.time()
+            
+            if (not dirty and processed != realigned and time.time() - max(last_change, last_update) >= realign):
+                logger.info("No changes for %d s, aligning all %d runs of '%s' again...", realign, len(processed_folders), experiment_name)
+                try:
+                    process_experiment(data_dir, cf_table, experiment_name, full_options, processed_folders)
+                except Exception as e:
+                    logger.error("Full alignment failed, retrying after the next change: %s: %s", type(e).__name__, e)
+                realigned = processed
+                continue
+            
+            if (not dirty or time.time() - last_change < debounce):
+                continue
+            
+            folders, signature, pending = ready_data_folders(data_dir, options.raw)
+            dirty = pending # Check again later for reports that are still being written
+            if (signature == processed or len(folders) == 0):
+                continue
+            
+            logger.info("Updating '%s' with %d runs...", experiment_name, len(folders))
+            try:
+                process_experiment(data_dir, cf_table, experiment_name, options, folders)
+                processed = signature
+                processed_folders = folders
+                last_update = time.time()
+                if (options.realign):
+                    realigned = signature # Every update is already a full alignment
+            except Exception as e:
+                logger.error("Update failed, retrying on the next change: %s: %s", type(e).__name__, e)
+    except KeyboardInterrupt:
+        print("Stopped watching '%s'" % data_dir)
+    finally:
+        watcher.close()
+
+# Read a batch manifest: a .json list of objects or a .csv file with a header, both with the fields data_dir, cf_file and
+# experiment_name, and optionally is_amounts. Returns a list of dicts.
+def read_manifest(manifest_file):
+    if (manifest_file.lower().endswith(".json")):
+        with open(manifest_file, "r") as f:
+            experiments = json.load(f)
+    else:
+        with open(manifest_file, newline = '') as f:
+            experiments = list(csv.DictReader(f))
+    
+    for experiment in experiments:
+        for field in ["data_dir", "cf_file", "experiment_name"]:
+            if (not experiment.get(field)):
+                raise ValueError("manifest entry %s has no %s" % (experiment, field))
+    
+    return experiments
+
+# Run one experiment of a batch and return its status instead of raising, so that failures stay isolated
+def run_batch_experiment(experiment, cf_table, options):
+    options = copy.copy(options)
+    if (experiment.get("is_amounts")):
+        options.is_amounts = experiment["is_amounts"]
+    
+    status = {'experiment_name': experiment["experiment_name"], 'data_dir': experiment["data_dir"], 'status': "ok",
+              'error': "", 'runs': 0, 'skipped': 0, 'rejected': 0}
+    # Experiments run in their own processes, so their stages are sent back with the status
+    if (options.profile):
+        profiler.enable()
+    
+    start = time.perf_counter()
+    try:
+        with profiler.stage("experiment " + experiment["experiment_name"]):
+            status.update(process_experiment(experiment["data_dir"], cf_table, experiment["experiment_name"], options))
+    except Exception as e:
+        status['status'] = "failed"
+        status['error'] = "%s: %s" % (type(e).__name__, e)
+    status['seconds'] = time.perf_counter() - start
+    status['profile'] = profiler.records
+    
+    return status
+
+# Process every experiment of a manifest, at most jobs at a time. Each cf file is parsed once and shared by all experiments
+# that use it. Prints a status line per experiment and a throughput summary, and returns the list of statuses.
+def run_batch(manifest_file, options, jobs = None):
+    import concurrent.futures
+    
+    experiments = read_manifest(manifest_file)
+    if (jobs is None):
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(experiments)))
+    
+    # Split the report reading processes between the experiments running at the same time
+    if (options.workers is None):
+        options.workers = max(1, (os.cpu_count() or 1) // jobs)
+    
+    start = time.perf_counter()
+    
+    cf_tables = {}
+    for experiment in experiments:
+        cf_file = experiment["cf_file"]
+        if (cf_file not in cf_tables):
+            try:
+                cf_tables[cf_file] = read_cf_file(cf_file)
+            except Exception as e:
+                cf_tables[cf_file] = "%s: %s" % (type(e).__name__, e)
+    
+    statuses = [None] * len(experiments)
+    with concurrent.futures.ProcessPoolExecutor(max_workers = jobs) as executor:
+        futures = {}
+        for i in range(0, len(experiments)):
+            cf_table = cf_tables[experiments[i]["cf_file"]]
+            if (isinstance(cf_table, str)):
+                statuses[i] = {'experiment_name': experiments[i]["experiment_name"], 'data_dir': experiments[i]["data_dir"],
+                               'status': "failed", 'error': cf_table, 'runs': 0, 'skipped': 0, 'rejected': 0, 'seconds': 0.0}
+            else:
+                futures[executor.submit(run_batch_experiment, experiments[i], cf_table, options)] = i
+        
+        for future in concurrent.futures.as_completed(futures):
+            statuses[futures[future]] = future.result()
+            profiler.merge(statuses[futures[future]].pop('profile'))
+    
+    elapsed = time.perf_counter() - start
+    
+    print("\nBatch summary:")
+    for status in statuses:
+        print("  %-6s %-30s %6d runs %4d skipped %4d rejected %8.2f s  %s" % (status['status'], status['experiment_name'], status['runs'],
+                                                                             status['skipped'], status['rejected'], status['seconds'], status['error']))
+    
+    succeeded = [status for status in statuses if status['status'] == "ok"]
+    runs = sum([status['runs'] for status in succeeded])
+    print("%d of %d experiments succeeded, %d runs in %.2f s (%.2f experiments/s, %.1f runs/s) with %d parallel jobs" %
+          (len(succeeded), len(statuses), runs, elapsed, len(statuses) / elapsed if elapsed > 0 else 0,
+           runs / elapsed if elapsed > 0 else 0, jobs))
+    
+    return statuses
+
+# Command line parser. Its defaults are also the defaults of get_options.
+def build_parser():
+    parser = argparse.ArgumentParser(usage = "\tgcproc.py [options] working_path cf_dir experiment_name\n\tgcproc.py [options]\n\tgcproc.py [options] --batch manifest\n\tgcproc.py [options] --serve ADDRESS")
+    parser.add_argument("paths", nargs = "*", help = argparse.SUPPRESS)
+    parser.add_argument("--backend", choices = ALIGN_BACKENDS, default = DEFAULT_BACKEND, help = "peak alignment backend (default: %(default)s)")
+    parser.add_argument("--workers", type = int, default = None, help = "number of processes used to read reports (default: CPU count)")
+    parser.add_argument("--raw", action = "store_true", help = "integrate the raw FID signal (.ch) files instead of reading Report.TXT")
+    parser.add_argument("--no-index", action = "store_true", help = "re-parse every report instead of using the data directory index")
+    parser.add_argument("--no-cache", action = "store_true", help = "align every input file instead of using cached alignments")
+    parser.add_argument("--clear-cache", action = "store_true", help = "delete all cached alignments before running")
+    parser.add_argument("--is-amounts", metavar = "FILE", help = "csv or xls file with the IS mass (mg) and Rxn (mmol) of every notebook code")
+    parser.add_argument("--export", metavar = "FORMATS", default = "", help = "comma separated yield export formats: " + ", ".join(YIELD_EXPORT_FORMATS))
+    parser.add_argument("--sqlite-db", metavar = "FILE", help = "with --export sqlite, write the SQLite tables of every experiment to one shared database FILE")
+    parser.add_argument("--time-course", action = "store_true", help = "add the mean, standard deviation and Front-Back difference per entry and time to the workbook and exports")
+    parser.add_argument("--incremental", action = "store_true", help = "only align samples that were not aligned in a previous run")
+    parser.add_argument("--realign", action = "store_true", help = "with --incremental, align all samples again (same result as a full run) and start a new incremental state")
+    parser.add_argument("--peak-window", type = float, metavar = "MINUTES", help = "drop peaks further than MINUTES from every reference retention time before alignment")
+    parser.add_argument("--naming", default = "default", help = "sample naming convention: " + ", ".join(sorted(gcnames.CONVENTIONS)) + " or a regular expression with named groups (default: default)")
+    parser.add_argument("--watch", action = "store_true", help = "keep running and update the results whenever new runs are complete")
+    parser.add_argument("--debounce", type = float, default = WATCH_DEBOUNCE, help = "seconds without changes before the watch mode updates (default: %(default)s)")
+    parser.add_argument("--poll", action = "store_true", help = "watch by polling the directory instead of using inotify")
+    parser.add_argument("-v", "--verbose", action = "count", default = 0, help = "show progress (-v) or every report and peak (-vv)")
+    parser.add_argument("--profile", metavar = "FILE", help = "write the wall time, CPU time, item count and peak memory of every stage to FILE")
+    parser.add_argument("--profile-format", choices = gcprof.PROFILE_FORMATS, default = "json", help = "JSON stage list or Chrome trace events (default: json)")
+    parser.add_argument("--serve", metavar = "ADDRESS", help = "run as a local service on HOST:PORT (e.g. 127.0.0.1:8765) or a Unix socket path")
+    parser.add_argument("--batch", metavar = "MANIFEST", help = "process every experiment of a .csv or .json manifest")
+    parser.add_argument("--jobs", type = int, default = None, help = "number of experiments processed at the same time in batch mode (default: CPU count)")
+    return parser
+
+# Options that can be set per job (library API and service), as opposed to the ones that control the command line run
+JOB_OPTIONS = ["backend", "workers", "raw", "no_index", "no_cache", "is_amounts", "export", "sqlite_db", "time_course", "incremental", "realign", "peak_window", "naming"]
+
+# Fill in the options derived from the parsed ones: the naming convention and the list of export formats. Raises
+# ValueError for invalid values.
+def prepare_options(options):
+    if (options.backend not in ALIGN_BACKENDS):
+        raise ValueError("unknown backend '%s'" % options.backend)
+    
+    try:
+        options.naming_convention = gcnames.get_convention(options.naming)
+    except re.error as e:
+        raise ValueError("invalid naming convention '%s': %s" % (options.naming, e))
+    
+    options.export_formats = [fmt for fmt in options.export.split(",") if fmt != ""]
+    for fmt in options.export_formats:
+        if (fmt not in YIELD_EXPORT_FORMATS):
+            raise ValueError("unknown export format '%s'" % fmt)
+    if (options.sqlite_db and "sqlite" not in options.export_formats):
+        raise ValueError("--sqlite-db requires --export sqlite")
+    
+    return options
+
+# Return processing options with the command line defaults, changed by the given job options, e.g.
+# get_options(backend = "r", export = "csv"). base is a previous set of options to start from instead of the defaults.
+def get_options(base = None, **overrides):
+    options = copy.copy(base) if base is not None else build_parser().parse_args([])
+    for name, value in overrides.items():
+        if (name not in JOB_OPTIONS):
+            raise ValueError("unknown option '%s'" % name)
+        setattr(options, name, value)
+    return prepare_options(options)
+
+# Run a job submitted to the service: {"data_dir": ..., "cf_file": ..., "experiment_name": ..., "options": {...}}. Job
+# options override the ones the service was started with. Returns the counts of process_experiment.
+def run_service_job(job, base_options):
+    for field in ["data_dir", "cf_file", "experiment_name"]:
+        if (not job.get(field)):
+            raise ValueError("job has no %s" % field)
+    
+    options = get_options(base_options, **job.get("options", {}))
+    cf_table = get_calibration(job["cf_file"])
+    with profiler.stage("experiment " + job["experiment_name"]):
+        return process_experiment(job["data_dir"], cf_table, job["experiment_name"], options)
+
+def main(argv = None):
     
     # Get arguments - working directory and experiment name
-    args = len(sys.argv) - 1
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    
+    logging.basicConfig(format = "%(levelname)s: %(message)s" if args.verbose == 0 else "%(message)s",
+                        level = [logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)])
+    if (args.profile):
+        profiler.enable()
+        atexit.register(profiler.write, args.profile, args.profile_format)
+    
+    try:
+        prepare_options(args)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    # The library functions raise exceptions on bad input or a failed alignment; only the command line exits
+    try:
+        run_command(args, parser)
+    except (ValueError, RuntimeError, ImportError) as e:
+        sys.exit("Error: %s" % e)
+
+# Run the command line mode selected by the parsed arguments: service, batch, or one experiment (optionally watched)
+def run_command(args, parser):
     data_dir = ""
     experiment_name = ""
     cf_dir = ""
     
-    if (args == 0):
+    if (args.clear_cache):
+        clear_align_cache()
+        print("Cleared alignment cache at '%s'" % ALIGN_CACHE_DIR)
+    
+    if (args.serve):
+        import gcserve
+        if (len(args.paths) != 0):
+            parser.error("--serve does not take a working path, cf file or experiment name")
+        gcserve.serve(args.serve, lambda job : run_service_job(job, args))
+        return
+    
+    if (args.batch):
+        if (len(args.paths) != 0):
+            parser.error("--batch does not take a working path, cf file or experiment name")
+        statuses = run_batch(args.batch, args, args.jobs)
+        sys.exit(0 if all([status['status'] == "ok" for status in statuses]) else 1)
+    
+    if (len(args.paths) == 0):
         data_dir = input("Enter working directory: ")
         cf_dir = input("Enter correction factor file directory: ")
         experiment_name = input("Enter experiment name: ")
-    elif (args == 3):
-        data_dir = sys.argv[1]
-        cf_dir = sys.argv[2]
-        experiment_name = sys.argv[3]
-        print('Found 3 arguments: "%s", "%s", "%s"' % (sys.argv[1], sys.argv[2], sys.argv[3]))
+    elif (len(args.paths) == 3):
+        data_dir, cf_dir, experiment_name = args.paths
+        logger.info('Found 3 arguments: "%s", "%s", "%s"', data_dir, cf_dir, experiment_name)
     else:
-        sys.exit("Usage:\tgcproc.py working_path cf_dir experiment_name\n\tgcproc.py experiment_name") 
-    
-    cf_table = read_cf_file(cf_dir)
-    
-    # Get Front and Back retention times
-    ret_times = format_ret(cf_dir)
-    print('\nFound %s front retention times.\nFound %s back retention times.' % (len(ret_times[0]), len(ret_times[1])))
-    peak_reference_front = ["peaks", "Filler", "Front", ret_times[0]]
-    peak_reference_back = ["peaks", "Filler", "Back", ret_times[1]]
-    
-    # extract reports and organize as back or front detector
-    data_list = os.listdir(data_dir)
-    data_folders = list(filter(re.compile(".*\.D").match, data_list))
-
-    report_extracted_front = []
-    report_extracted_back = []
-    
-    for i in range(len(data_folders)):
-        extract = extract_report_txt(data_dir + "/" + data_folders[i] + "/Report.TXT")
-        if (extract[1] == "Front"):
-            report_extracted_front.append(extract)
-        else:
-            report_extracted_back.append(extract)
-    
-    print("Extracted Report: ")
-    print(report_extracted_front)
-    print(report_extracted_back)
-    
-    # Generate input files for GCalignR and process data
-    generate_input_file(convert_time(report_extracted_front), data_dir + '/input_data_front.txt', peak_reference_front) 
-    generate_input_file(convert_time(report_extracted_back), data_dir + '/input_data_back.txt', peak_reference_back)
-    
-    print("generated input files")
-    front_areas = get_area(data_dir + '/input_data_front.txt', os.getcwd() + '/gcproc.R')
-    back_areas = get_area(data_dir + '/input_data_back.txt', os.getcwd() + '/gcproc.R')
-    front_areas = fix_area_orders(front_areas, get_is_index(cf_dir))
-    back_areas = fix_area_orders(back_areas, get_is_index(cf_dir))
-    
-    # Add table headers and sort
-    for entry in front_areas:
-        entry.insert(0, "Front")
-    for entry in back_areas:
-        entry.insert(0, "Back")
-        
-    all_areas = sort_by_time(front_areas + back_areas)
+        parser.print_usage()
+        sys.exit(2)
     
-    # write data to excel workbook
-    analytes = get_names(cf_table)
-    is_mw = get_is_mw(cf_table)
-    cf = get_corr_factors(cf_table)
-    write_xl(data_dir, experiment_name, all_areas, cf, analytes, is_mw)
+    with profiler.stage("cf file"):
+        cf_table = get_calibration(cf_dir)
+    if (args.watch):
+        watch_experiment(data_dir, cf_table, experiment_name, args, args.debounce, args.poll)
+    else:
+        with profiler.stage("experiment " + experiment_name):
+            status = process_experiment(data_dir, cf_table, experiment_name, args)
+        if (args.peak_window is not None):
+            print_peak_report(status['peak_report'], args.peak_window)
     
     # Save working directory
     config = {'working_directory': data_dir, 'cf_file_name': cf_dir}
@@ -0,0 +1,102 @@
+# Purpose: stage-level profiling for gcproc's --profile option. Records the wall time, CPU time, item count and peak
+# memory of every stage and writes them as JSON or as Chrome trace events (open in chrome://tracing or Perfetto).
+# Note: peak memory is the peak of memory allocated by python (tracemalloc) during the stage, which slows down allocation
+# heavy code, so it is only tracked while profiling. CPU time is the time of this process; work done in worker processes
+# (e.g. the report reading pool or R) shows up in the wall time only.
+
+import contextlib
+import threading
+import tracemalloc
+import json
+import time
+import os
+
+try:
+    import resource
+except ImportError:
+    resource = None # Not available on Windows
+
+PROFILE_FORMATS = ["json", "trace"]
+
+# One profiled stage. items can be set inside the stage once the number of processed items is known.
+class Stage:
+    __slots__ = ["name", "items", "start", "wall", "cpu", "peak", "depth", "pid", "tid"]
+
+    def __init__(self, name, items, depth):
+        self.name = name
+        self.items = items
+        self.depth = depth
+        self.start = time.time()
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak = 0
+        self.pid = os.getpid()
+        self.tid = threading.get_ident()
+
+    def to_dict(self):
+        return {'name': self.name, 'items': self.items, 'start': self.start, 'wall_s': self.wall, 'cpu_s': self.cpu,
+                'peak_kb': self.peak // 1024, 'depth': self.depth, 'pid': self.pid, 'tid': self.tid}
+
+class Profiler:
+    def __init__(self, enabled = False):
+        self.enabled = False
+        self.records = []
+        self.stack = []
+        if (enabled):
+            self.enable()
+
+    def enable(self):
+        self.enabled = True
+        self.records = []
+        self.stack = []
+        if (not tracemalloc.is_tracing()):
+            tracemalloc.start()
+
+    # Time the code inside the with block as a stage. Does nothing (and costs next to nothing) unless enabled. Stages can
+    # be nested; the peak memory of a stage includes the one of its inner stages.
+    @contextlib.contextmanager
+    def stage(self, name, items = None):
+        if (not self.enabled):
+            yield Stage(name, items, 0)
+            return
+
+        if (len(self.stack) > 0):
+            self.stack[-1].peak = max(self.stack[-1].peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+
+        stage = Stage(name, items, len(self.stack))
+        self.stack.append(stage)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield stage
+        finally:
+            stage.wall = time.perf_counter() - wall
+            stage.cpu = time.process_time() - cpu
+            stage.peak = max(stage.peak, tracemalloc.get_traced_memory()[1])
+            self.stack.pop()
+            if (len(self.stack) > 0):
+                self.stack[-1].peak = max(self.stack[-1].peak, stage.peak)
+            self.records.append(stage.to_dict())
+
+    # Add the records of another process (e.g. a batch experiment)
+    def merge(self, records):
+        self.records.extend(records)
+
+    def to_json(self):
+        return {'stages': sorted(self.records, key = lambda record : record['start']),
+                'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None}
+
+    # Complete ("X") events in microseconds relative to the first stage, with the CPU time, items and peak memory as args
+    def to_trace(self):
+        start = min([record['start'] for record in self.records] + [time.time()])
+        events = []
+        for record in self.records:
+            events.append({'name': record['name'], 'ph': "X", 'pid': record['pid'], 'tid': record['tid'],
+                           'ts': int((record['start'] - start) * 1e6), 'dur': int(record['wall_s'] * 1e6),
+                           'args': {'cpu_s': record['cpu_s'], 'items': record['items'], 'peak_kb': record['peak_kb']}})
+        return {'traceEvents': events, 'displayTimeUnit': "ms"}
+
+    def write(self, output_file, fmt = "json"):
+        with open(output_file, "w") as f:
+            json.dump(self.to_trace() if fmt == "trace" else self.to_json(), f, indent = 1)
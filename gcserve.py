@@ -0,0 +1,156 @@
+# Purpose: optional long-running local service for gcproc (gcproc.py --serve ADDRESS). Jobs are submitted as JSON over
+# HTTP on localhost or on a Unix socket and run one at a time in the service process, so the interpreter, the imported
+# modules, the calibration tables and the alignment backend (e.g. the persistent GCalignR workers) stay warm between jobs.
+# Note: there is no authentication. Bind to 127.0.0.1 or use a Unix socket with suitable file permissions.
+#
+# Endpoints:
+#   POST /jobs        submit a job, e.g. {"data_dir": "...", "cf_file": "...", "experiment_name": "...", "options": {"export": "csv"}}
+#                     returns {"id": ..., "status": "queued"}; with ?wait=1 the reply is sent once the job has finished
+#   GET  /jobs/<id>   status of a job: queued, running, ok or failed, with its result or error
+#   GET  /jobs        status of all jobs
+
+import socketserver
+import http.server
+import threading
+import logging
+import queue
+import stat
+import json
+import time
+import os
+
+logger = logging.getLogger("gcproc")
+
+MAX_REQUEST_BYTES = 1024 * 1024
+MAX_FINISHED_JOBS = 1000 # Oldest finished jobs are forgotten beyond this
+
+# Runs submitted jobs one at a time on a worker thread. run_job is called with the job (a dict) and returns the result.
+class JobQueue:
+    def __init__(self, run_job):
+        self.run_job = run_job
+        self.jobs = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target = self.work, daemon = True)
+        self.thread.start()
+
+    def submit(self, job):
+        with self.lock:
+            job_id = self.next_id
+            self.next_id += 1
+            self.jobs[job_id] = {'id': job_id, 'status': "queued", 'submitted': time.time(), 'result': None, 'error': ""}
+            status = dict(self.jobs[job_id])
+        self.queue.put((job_id, job))
+        return status
+
+    def get(self, job_id):
+        with self.lock:
+            return dict(self.jobs[job_id]) if job_id in self.jobs else None
+
+    def all(self):
+        with self.lock:
+            return [dict(status) for status in self.jobs.values()]
+
+    # Wait until a job has finished and return its status
+    def wait(self, job_id):
+        with self.finished:
+            self.finished.wait_for(lambda : self.jobs[job_id]['status'] in ("ok", "failed"))
+            return dict(self.jobs[job_id])
+
+    def work(self):
+        while True:
+            job_id, job = self.queue.get()
+            with self.lock:
+                self.jobs[job_id]['status'] = "running"
+            logger.info("Running job %d: %s", job_id, job)
+
+            start = time.perf_counter()
+            try:
+                result, status, error = self.run_job(job), "ok", ""
+            except Exception as e:
+                result, status, error = None, "failed", "%s: %s" % (type(e).__name__, e)
+                logger.error("Job %d failed: %s", job_id, error)
+
+            with self.finished:
+                self.jobs[job_id].update({'status': status, 'result': result, 'error': error,
+                                          'seconds': time.perf_counter() - start})
+                done = [other for other in self.jobs if self.jobs[other]['status'] in ("ok", "failed")]
+                for other in done[:max(0, len(done) - MAX_FINISHED_JOBS)]:
+                    del self.jobs[other]
+                self.finished.notify_all()
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    jobs = None # JobQueue, set by serve
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        if (path == "/jobs"):
+            return self.reply(200, self.jobs.all())
+        if (path.startswith("/jobs/") and path[len("/jobs/"):].isdigit()):
+            status = self.jobs.get(int(path[len("/jobs/"):]))
+            if (status is not None):
+                return self.reply(200, status)
+        self.reply(404, {'error': "not found"})
+
+    def do_POST(self):
+        path, _, query = self.path.partition("?")
+        if (path.rstrip("/") != "/jobs"):
+            return self.reply(404, {'error': "not found"})
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if (length > MAX_REQUEST_BYTES):
+            return self.reply(413, {'error': "request too large"})
+        try:
+            job = json.loads(self.rfile.read(length) or b"{}")
+            if (not isinstance(job, dict) or not isinstance(job.get("options", {}), dict)):
+                raise ValueError("a job is a JSON object with an optional \"options\" object")
+        except ValueError as e:
+            return self.reply(400, {'error': str(e)})
+
+        status = self.jobs.submit(job)
+        if ("wait=1" in query.split("&")):
+            status = self.jobs.wait(status['id'])
+            return self.reply(200 if status['status'] == "ok" else 500, status)
+        self.reply(202, status)
+
+    # Unix socket clients have no address
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        logger.info("%s - %s", self.address_string(), format % args)
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+# Serve jobs on address, either HOST:PORT or the path of a Unix socket, until interrupted
+def serve(address, run_job):
+    handler = type("JobRequestHandler", (RequestHandler,), {'jobs': JobQueue(run_job)})
+
+    if (":" in address and os.path.sep not in address):
+        host, port = address.rsplit(":", 1)
+        server = http.server.ThreadingHTTPServer((host or "127.0.0.1", int(port)), handler)
+    else:
+        if (os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode)):
+            os.remove(address) # Stale socket of a previous service
+        server = UnixHTTPServer(address, handler)
+
+    print("Serving gcproc jobs on %s, press Ctrl+C to stop..." % address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopped serving on %s" % address)
+    finally:
+        server.server_close()
+        if (not isinstance(server, http.server.ThreadingHTTPServer) and os.path.exists(address)):
+            os.remove(address)
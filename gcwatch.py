@@ -0,0 +1,101 @@
+# Purpose: wait for changes in a data directory for gcproc's watch mode. Uses Linux inotify (through ctypes, no extra
+# packages) on the data directory and every "*.D" folder in it, and falls back to polling directory snapshots elsewhere.
+# Note: watchers only report that something changed; the caller rescans the directory to find out what.
+
+import ctypes.util
+import ctypes
+import select
+import time
+import os
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+# List the "*.D" folders of a data directory
+def list_data_folders(data_dir):
+    return sorted([name for name in os.listdir(data_dir) if name.endswith(".D") and os.path.isdir(os.path.join(data_dir, name))])
+
+# Snapshot of a data directory: (name, mtime, size) of every file directly inside the "*.D" folders
+def snapshot(data_dir):
+    entries = []
+    for folder in list_data_folders(data_dir):
+        try:
+            for entry in os.scandir(os.path.join(data_dir, folder)):
+                if (entry.is_file()):
+                    stat = entry.stat()
+                    entries.append((folder + "/" + entry.name, stat.st_mtime, stat.st_size))
+        except OSError:
+            pass # Folder removed while scanning
+    return entries
+
+class PollingWatcher:
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.last = snapshot(data_dir)
+
+    # Sleep for timeout seconds and return True if the directory changed since the last call
+    def wait(self, timeout):
+        time.sleep(timeout)
+        current = snapshot(self.data_dir)
+        changed = current != self.last
+        self.last = current
+        return changed
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK)
+        if (self.fd < 0):
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched = set()
+        self.add_watch(data_dir)
+        self.add_folders()
+
+    def add_watch(self, path):
+        if (self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK) < 0):
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for '%s'" % path)
+        self.watched.add(path)
+
+    # Watch "*.D" folders created since the last call
+    def add_folders(self):
+        for folder in list_data_folders(self.data_dir):
+            path = os.path.join(self.data_dir, folder)
+            if (path not in self.watched):
+                try:
+                    self.add_watch(path)
+                except OSError:
+                    pass # Folder removed before it could be watched
+
+    # Wait up to timeout seconds and return True if anything changed in the directory or its "*.D" folders
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if (not ready):
+            return False
+        try:
+            while (os.read(self.fd, 65536)):
+                pass
+        except BlockingIOError:
+            pass
+        self.add_folders()
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+# Return an inotify watcher for the data directory, or a polling watcher if inotify is unavailable or polling is forced
+def get_watcher(data_dir, poll = False):
+    if (not poll):
+        try:
+            return InotifyWatcher(data_dir)
+        except (OSError, AttributeError, TypeError):
+            pass # Not Linux, or out of inotify watches
+    return PollingWatcher(data_dir)
@@ -0,0 +1,29 @@
+# Usage: python tests/make_align_fixtures.py
+#
+# Purpose: align every input file in tests/fixtures/align with GCalignR (gcproc.R through RScript) and save the analyte
+# area table next to it as <case>.gcalignr.csv. test_gcalign.py compares the native backend against these files.
+# Note: requires R with the GCalignR package (see requirements_R.txt). Re-run after changing the parameters in gcproc.R.
+
+import glob
+import csv
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gcproc
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "align")
+
+def main():
+    for input_file in sorted(glob.glob(FIXTURE_DIR + "/*.txt")):
+        table = gcproc.get_area(input_file, gcproc.R_SCRIPT, "rscript")
+        output_file = input_file[:-len(".txt")] + ".gcalignr.csv"
+        with open(output_file, "w", newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(["sample"] + ["peak%d" % (col + 1) for col in range(0, table.areas.shape[1])])
+            writer.writerows(table.to_rows())
+        print("Wrote '%s'" % output_file)
+
+if __name__ == "__main__":
+    main()
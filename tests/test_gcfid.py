@@ -0,0 +1,69 @@
+# Tests of raw signal integration (gcfid.py) on synthetic version 179 .ch files with Gaussian peaks of known retention
+# time and area on a sloped, noisy baseline.
+
+import struct
+import sys
+import os
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gcfid
+import gcproc
+
+END_MINUTES = 10.0
+POINTS = 12001 # 20 Hz
+SCALING = 0.25
+PEAKS = [(2.0, 0.02, 400.0), (5.0, 0.03, 150.0), (7.5, 0.02, 60.0)] # RT (min), sigma (min), height (pA)
+
+# Area in pA*s of a Gaussian peak given in minutes
+def peak_area(sigma, height):
+    return height * sigma * 60 * np.sqrt(2 * np.pi)
+
+# Write a version 179 .ch file of the synthetic signal and return its path
+def write_ch_file(path, peaks = PEAKS, seed = 0):
+    times = np.linspace(0, END_MINUTES, POINTS)
+    signal = 5 + 0.5 * times + np.random.default_rng(seed).normal(0, 0.05, POINTS)
+    for rt, sigma, height in peaks:
+        signal += height * np.exp(-0.5 * ((times - rt) / sigma) ** 2)
+
+    header = bytearray(gcfid.DATA_OFFSET)
+    header[0:4] = b"\x03179"
+    header[gcfid.TIME_OFFSET:gcfid.TIME_OFFSET + 8] = struct.pack(">ff", 0, END_MINUTES * 60000)
+    header[gcfid.SCALING_OFFSET:gcfid.SCALING_OFFSET + 8] = struct.pack(">d", SCALING)
+
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, "wb") as f:
+        f.write(bytes(header))
+        f.write((signal / SCALING).astype("<f8").tobytes())
+    return path
+
+def test_read_ch_file(tmp_path):
+    times, samples, scaling = gcfid.read_ch_file(write_ch_file(str(tmp_path / "S1.D" / "FID1A.ch")))
+    assert isinstance(samples, np.memmap)
+    assert len(times) == len(samples) == POINTS
+    assert times[0] == 0 and times[-1] == pytest.approx(END_MINUTES)
+    assert scaling == SCALING
+
+def test_unsupported_version(tmp_path):
+    path = write_ch_file(str(tmp_path / "S1.D" / "FID1A.ch"))
+    with open(path, "r+b") as f:
+        f.write(b"\x03181")
+    with pytest.raises(ValueError):
+        gcfid.read_ch_file(path)
+
+def test_integrate_signal_file(tmp_path):
+    name, detector, ret_times, areas = gcfid.integrate_signal_file(write_ch_file(str(tmp_path / "S1.D" / "FID2B.ch")))
+    assert (name, detector) == ("S1", "Back")
+    np.testing.assert_allclose(ret_times, [rt for rt, sigma, height in PEAKS], atol = 0.002)
+    np.testing.assert_allclose(areas, [peak_area(sigma, height) for rt, sigma, height in PEAKS], rtol = 0.02)
+
+# Both detector files of a folder are ingested, each as its own run
+def test_ingest_every_signal_file(tmp_path):
+    write_ch_file(str(tmp_path / "S1.D" / "FID1A.ch"))
+    write_ch_file(str(tmp_path / "S1.D" / "FID2B.ch"), PEAKS[:2], seed = 1)
+    runs, errors = gcproc.ingest_reports(str(tmp_path), ["S1.D"], workers = 1, use_index = False, raw = True)
+    assert errors == []
+    assert [(run.sample_name, run.detector, len(run.rt)) for run in runs] == [("S1", "Front", 3), ("S1", "Back", 2)]
@@ -0,0 +1,52 @@
+# Tests of incremental alignment (gcproc.get_areas_incremental) against a full alignment of the same samples, on the
+# synthetic Front input file in fixtures/align, with the native backend and without the alignment cache.
+
+import sys
+import os
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gcalign
+import gcproc
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "align", "synthetic_front.txt")
+
+# Return the peak reference and the sample Runs of an input file
+def read_runs(input_file):
+    names, samples = gcalign.read_input_file(input_file)
+    runs = [gcproc.Run(name, "Front", rt, area) for name, (rt, area) in zip(names, samples)]
+    return runs[names.index("peaks")], [run for run in runs if run.name != "peaks"]
+
+def full_alignment(runs, reference, input_file):
+    gcproc.generate_input_file(runs, input_file, reference)
+    return gcproc.get_areas([input_file], gcproc.R_SCRIPT, "native", use_cache = False)[0]
+
+def incremental_alignment(runs, reference, input_file, realign = False):
+    return gcproc.get_areas_incremental([[runs, reference, input_file]], gcproc.R_SCRIPT, "native", use_cache = False,
+                                        realign = realign)[0]
+
+def test_first_incremental_run_matches_full(tmp_path):
+    reference, runs = read_runs(FIXTURE)
+    full = full_alignment(runs, reference, str(tmp_path / "full.txt"))
+    incremental = incremental_alignment(runs, reference, str(tmp_path / "input_data_front.txt"))
+    assert incremental.names == full.names
+    np.testing.assert_array_equal(incremental.areas, full.areas)
+
+# Samples aligned before keep their areas when new samples arrive; --realign gives the areas of a full alignment again
+def test_added_samples_and_realign(tmp_path):
+    reference, runs = read_runs(FIXTURE)
+    input_file = str(tmp_path / "input_data_front.txt")
+    first = incremental_alignment(runs[:12], reference, input_file)
+
+    incremental = incremental_alignment(runs, reference, input_file)
+    assert incremental.names == [run.name for run in runs]
+    np.testing.assert_array_equal(incremental.areas[:12], first.areas)
+
+    full = full_alignment(runs, reference, str(tmp_path / "full.txt"))
+    realigned = incremental_alignment(runs, reference, input_file, realign = True)
+    np.testing.assert_array_equal(realigned.areas, full.areas)
+
+    # The new state is the full alignment, so a following incremental run changes nothing
+    np.testing.assert_array_equal(incremental_alignment(runs, reference, input_file).areas, full.areas)